@@ -0,0 +1,187 @@
+import argparse
+import glob
+import io
+import os
+import sys
+
+import pandas as pd
+
+import instrumentation
+from file_processor import FileProcessor, get_process_pool
+from name_matcher import NameMatcher
+from prioritizer import Prioritizer
+
+
+class BatchProcessor:
+    # 複数の薬局の不良在庫CSVをまとめて処理する（一括処理）
+    # OMEC他院所ファイルと在庫金額CSVは一度だけ読み込み、不良在庫CSVは
+    # プロセスプールで並列に読み込んで、薬局の列（薬局ID）を付ける。
+    # 読み込んだものから順に1回の process_data で処理し、全薬局の在庫を
+    # まとめた院所別のExcelを作成する
+    # 並列数の既定値は環境変数 BATCH_WORKERS（未設定時はCPU数）
+
+    def __init__(self, workers=None, cache=None, fuzzy_match=True,
+                 prioritizer=None):
+        if workers is None:
+            workers = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+        self.workers = workers
+        # 読み込んだ購入履歴・対応表を保持する PipelineCache（画面から使う場合）
+        self.cache = cache
+        self.fuzzy_match = fuzzy_match
+        self.prioritizer = prioritizer or Prioritizer()
+
+    @staticmethod
+    def pharmacy_id(file_name):
+        # ファイル名（拡張子を除く）を薬局IDとして使う
+        return os.path.splitext(os.path.basename(file_name))[0]
+
+    @staticmethod
+    def _read_inventory(file_name, content):
+        # 不良在庫CSVを1つ読み込み、薬局の列を付けて返す（プロセスプールで実行）
+        chunks = list(FileProcessor.iter_inventory_chunks(io.BytesIO(content)))
+        if chunks:
+            inventory_df = pd.concat(chunks, ignore_index=True)
+        else:
+            inventory_df = pd.DataFrame(columns=FileProcessor.INVENTORY_COLUMNS)
+        return inventory_df.assign(
+            **{FileProcessor.SOURCE_COLUMN: BatchProcessor.pharmacy_id(file_name)})
+
+    def _cached(self, key, compute):
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute(key, compute)
+
+    def iter_inventories(self, inventory_files):
+        # inventory_files（[(ファイル名, バイト列)]）を並列に読み込み、
+        # 渡した順に返す（処理側は読み込みが終わったものから処理できる）
+        names = [name for name, _ in inventory_files]
+        contents = [content for _, content in inventory_files]
+        if self.workers <= 1 or len(inventory_files) <= 1:
+            for name, content in inventory_files:
+                yield self._read_inventory(name, content)
+            return
+        yield from instrumentation.timed_iter(
+            'batch.read_inventory',
+            get_process_pool(self.workers).map(BatchProcessor._read_inventory,
+                                               names, contents))
+
+    def process(self, purchase_file, yj_code_file, inventory_files):
+        # purchase_file・yj_code_file はファイルオブジェクト、inventory_files は
+        # [(ファイル名, バイト列)]。結果・在庫データ・Excelのバイト列を返す
+        pharmacy_ids = [self.pharmacy_id(name) for name, _ in inventory_files]
+        if len(set(pharmacy_ids)) != len(pharmacy_ids):
+            raise ValueError(
+                "同じ薬局IDになる不良在庫ファイルがあります（ファイル名を変えてください）")
+
+        with instrumentation.stage('batch.read_masters'):
+            purchase_index = self._cached(
+                ('purchase_index', FileProcessor.content_hash(purchase_file)),
+                lambda: FileProcessor.build_purchase_index(
+                    FileProcessor.read_purchase_history(
+                        purchase_file,
+                        optional_columns=[
+                            FileProcessor.PURCHASE_DATE_COLUMN,
+                            FileProcessor.PURCHASE_QUANTITY_COLUMN,
+                        ],
+                        dedupe=False)))
+            yj_hash = FileProcessor.content_hash(yj_code_file)
+            yj_master = self._cached(
+                ('yj_master', yj_hash), lambda: FileProcessor.build_yj_master(
+                    FileProcessor.read_csv(yj_code_file)))
+            name_matcher = None
+            if self.fuzzy_match:
+                name_matcher = self._cached(('name_matcher', yj_hash),
+                                            lambda: NameMatcher(yj_master))
+
+        with instrumentation.stage('batch.process',
+                                   files=len(inventory_files)) as metrics:
+            result_df, inventory_df = FileProcessor.process_data(
+                None,
+                self.iter_inventories(inventory_files),
+                yj_master=yj_master,
+                return_inventory=True,
+                purchase_index=purchase_index,
+                name_matcher=name_matcher,
+                prioritizer=self.prioritizer)
+            metrics['rows_out'] = len(result_df)
+
+        excel = FileProcessor.generate_excel(result_df, streaming=True)
+        return {
+            'result_df': result_df,
+            'inventory_df': inventory_df,
+            'excel': excel.getvalue(),
+        }
+
+
+def _inventory_paths(paths):
+    # ディレクトリを指定した場合は、その中のCSVをすべて対象にする
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '*.csv')))
+        else:
+            yield path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='複数の薬局の不良在庫CSVをまとめて処理し、院所別のExcelを作成する')
+    parser.add_argument('inventory',
+                        nargs='+',
+                        help='不良在庫CSV（またはそれを含むディレクトリ）。'
+                        'ファイル名を薬局IDとして使う')
+    parser.add_argument('--purchase', required=True, help='OMEC他院所 (XLSX)')
+    parser.add_argument('--master', required=True, help='在庫金額 (CSV)')
+    parser.add_argument('--out', default='不良在庫_全薬局.xlsx',
+                        help='出力するExcelファイル')
+    parser.add_argument('--zip', default=None,
+                        help='院所ごとのファイルをまとめたZIPも出力する場合のパス')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='不良在庫CSVを並列に読み込むプロセス数')
+    parser.add_argument('--top-n', type=int, default=None,
+                        help='院所ごとに出力する優先度上位の件数')
+    parser.add_argument('--no-fuzzy', action='store_true',
+                        help='薬品名のあいまい照合を行わない')
+    parser.add_argument('--save', action='store_true',
+                        help='在庫データを薬局ごとにデータベースへ保存する（PG* の環境変数が必要）')
+    args = parser.parse_args()
+
+    instrumentation.configure_logging(os.environ.get('LOG_LEVEL', 'WARNING'))
+    inventory_files = []
+    for path in _inventory_paths(args.inventory):
+        with open(path, 'rb') as f:
+            inventory_files.append((path, f.read()))
+    if not inventory_files:
+        sys.exit("不良在庫CSVが見つかりません")
+
+    with open(args.purchase, 'rb') as f:
+        purchase_file = io.BytesIO(f.read())
+    with open(args.master, 'rb') as f:
+        yj_code_file = io.BytesIO(f.read())
+
+    processor = BatchProcessor(workers=args.workers,
+                               fuzzy_match=not args.no_fuzzy,
+                               prioritizer=Prioritizer(top_n=args.top_n))
+    with instrumentation.run('batch', files=len(inventory_files)) as report:
+        result = processor.process(purchase_file, yj_code_file,
+                                   inventory_files)
+        if args.save:
+            from database import Database
+            db = Database()
+            for pharmacy_id, inventory_df in result['inventory_df'].groupby(
+                    FileProcessor.SOURCE_COLUMN, sort=False):
+                db.save_inventory(inventory_df, pharmacy_id=pharmacy_id)
+        if args.zip:
+            with open(args.zip, 'wb') as f:
+                f.write(
+                    FileProcessor.generate_excel_zip(
+                        result['result_df']).getvalue())
+
+    with open(args.out, 'wb') as f:
+        f.write(result['excel'])
+
+    counts = result['inventory_df'].groupby(FileProcessor.SOURCE_COLUMN,
+                                            sort=False).size()
+    for pharmacy_id, rows in counts.items():
+        print(f"{pharmacy_id}: {rows:,} 行")
+    print(f"{len(inventory_files)} ファイル / 結果 {len(result['result_df']):,} 行 / "
+          f"{report.seconds:.1f}秒 → {args.out}")
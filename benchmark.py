@@ -0,0 +1,419 @@
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import chardet
+import pandas as pd
+
+import generate_sample_data
+import instrumentation
+from file_processor import FileProcessor
+from name_matcher import NameMatcher
+from prioritizer import Prioritizer
+
+# 文字コード判定のベンチマークに使うファイルサイズ（バイト）
+ENCODING_SIZES = [100_000, 1_000_000, 10_000_000, 50_000_000]
+# 従来の判定（ファイル全体を chardet に渡す）を測る上限
+CHARDET_FULL_LIMIT = 1_000_000
+# 処理全体のベンチマークで使う不良在庫の行数
+PIPELINE_SIZES = [1_000, 10_000, 100_000]
+# 起動時間のベンチマークで読み込むモジュール（画面が使う時に読み込むもの）
+STARTUP_MODULES = ['pipeline_cache', 'file_processor', 'job_queue',
+                   'batch_process']
+# 薬品名のあいまい照合の確認に使う対応表と、照合の期待値（None は照合しない）
+NAME_MATCH_MASTER = {
+    'アムロジピン錠5mg「サワイ」': '2171022F1001',
+    'アムロジピンOD錠5mg「明治」': '2171022F2002',
+    'アムロジピン錠5mg「DSEP」': '2171022F1003',
+    'ファモチジン錠10mg「日医工」': '2325003F1004',
+    'ファモチジンOD錠10mg「日医工」': '2325003F2005',
+    'ロキソプロフェンナトリウム錠60mg「サワイ」': '1149019F1006',
+}
+NAME_MATCH_CASES = [
+    # 1文字の打ち間違い
+    ('アムロジビン錠5mg「サワイ」', 'アムロジピン錠5mg「サワイ」'),
+    # 塩の表記ゆれ
+    ('ロキソプロフェンNa錠60mg「サワイ」', 'ロキソプロフェンナトリウム錠60mg「サワイ」'),
+    # 剤形が違う（OD錠）
+    ('アムロジピン錠5mg「明治」', None),
+    # 製造販売元が違う
+    ('アムロジピン錠5mg「EP」', None),
+    # 製造販売元がない
+    ('ファモチジン錠10mg', None),
+    # 錠・OD錠のどちらの打ち間違いか決められない
+    ('ファモチジンD錠10mg「日医工」', None),
+]
+# 回帰の判定に使う過去の記録の件数
+HISTORY_WINDOW = 5
+# 回帰とみなさない短い工程（秒）
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def make_csv_bytes(size, encoding):
+    # 在庫金額CSVに似た内容を指定サイズまで繰り返したバイト列を作る
+    header = '薬品名,ＹＪコード,単位,在庫金額\n'
+    lines = [
+        f'アムロジピン錠{i % 10}mg「サワイ」,2171022F{i:04d},錠,{i * 13}\n'
+        for i in range(1000)
+    ]
+    block = ''.join(lines).encode(encoding)
+    body = block * (size // len(block) + 1)
+    return header.encode(encoding) + body[:size]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_encoding(args):
+    print(f"{'encoding':<10}{'size':>12}{'detected':>10}{'conf':>6}"
+          f"{'tiered[s]':>11}{'chardet[s]':>12}")
+    for encoding in ['utf-8', 'cp932', 'euc_jp']:
+        for size in ENCODING_SIZES:
+            data = make_csv_bytes(size, encoding)
+            (detected, confidence), elapsed = timed(
+                FileProcessor.detect_encoding_with_confidence, data)
+            if size <= CHARDET_FULL_LIMIT:
+                _, chardet_elapsed = timed(chardet.detect, data)
+                chardet_text = f'{chardet_elapsed:.4f}'
+            else:
+                chardet_text = '-'
+            print(f'{encoding:<10}{size:>12,}{detected:>10}{confidence:>6.2f}'
+                  f'{elapsed:>11.4f}{chardet_text:>12}')
+
+
+def run_pipeline(files, save_to_db=False, max_clinics_per_lot=None,
+                 top_n=None):
+    # アップロードのジョブと同じ順序で処理する（各工程は instrumentation で記録）
+    purchase_index = FileProcessor.build_purchase_index(
+        FileProcessor.read_purchase_history(
+            io.BytesIO(files['purchase']),
+            optional_columns=[
+                FileProcessor.PURCHASE_DATE_COLUMN,
+                FileProcessor.PURCHASE_QUANTITY_COLUMN,
+            ],
+            dedupe=False),
+        max_clinics=max_clinics_per_lot)
+    yj_master = FileProcessor.build_yj_master(
+        FileProcessor.read_csv(io.BytesIO(files['master'])))
+    result_df, inventory_df = FileProcessor.process_data(
+        None,
+        FileProcessor.iter_inventory_chunks(io.BytesIO(files['inventory'])),
+        yj_master=yj_master,
+        return_inventory=True,
+        purchase_index=purchase_index,
+        prioritizer=Prioritizer(top_n=top_n))
+    FileProcessor.generate_excel(result_df, streaming=True)
+    if save_to_db:
+        from database import Database
+        Database().save_inventory(inventory_df, pharmacy_id='benchmark')
+    return result_df
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history, threshold):
+    # 同じベンチマーク・同じ条件の直近の記録の中央値と比べ、
+    # threshold 倍を超えて遅くなった工程を返す
+    previous = [
+        r for r in history
+        if r['benchmark'] == record['benchmark'] and r['params'] == record['params']
+    ][-HISTORY_WINDOW:]
+    regressions = []
+    for stage, seconds in record['stages'].items():
+        baseline = [r['stages'][stage] for r in previous if stage in r['stages']]
+        if not baseline:
+            continue
+        median = statistics.median(baseline)
+        if seconds > median * threshold and seconds - median > MIN_REGRESSION_SECONDS:
+            regressions.append((stage, median, seconds))
+    return regressions
+
+
+def bench_pipeline(args):
+    # 生成したサンプルデータで各工程の所要時間を測り、履歴（JSONL）と比較する
+    history = load_history(args.history)
+    revision = git_revision()
+    regressed = False
+    print(f"{'rows':>10}{'clinics':>9}{'stage':>28}{'seconds':>10}"
+          f"{'rows_out':>11}{'baseline':>10}")
+    for rows in args.sizes:
+        files = generate_sample_data.generate(inventory_rows=rows,
+                                              clinics=args.clinics,
+                                              seed=args.seed)
+        params = {
+            'rows': rows,
+            'clinics': args.clinics,
+            'seed': args.seed,
+            'max_clinics_per_lot': args.max_clinics_per_lot,
+            'top_n': args.top_n,
+            'db': args.db,
+        }
+        with instrumentation.run('benchmark', **params) as report:
+            run_pipeline(files,
+                         save_to_db=args.db,
+                         max_clinics_per_lot=args.max_clinics_per_lot,
+                         top_n=args.top_n)
+
+        report_dict = report.to_dict()
+        record = {
+            'benchmark': 'pipeline',
+            'recorded_at': datetime.now().isoformat(timespec='seconds'),
+            'revision': revision,
+            'params': params,
+            'seconds': report_dict['seconds'],
+            'rss_peak_mb': report_dict['rss_peak_mb'],
+            'stages': {s['stage']: s['seconds'] for s in report_dict['stages']},
+        }
+        record['stages']['total'] = report_dict['seconds']
+        regressions = find_regressions(record, history, args.threshold)
+        baselines = {stage: median for stage, median, _ in regressions}
+
+        for stage in report_dict['stages'] + [{
+                'stage': 'total',
+                'seconds': report_dict['seconds']
+        }]:
+            baseline = baselines.get(stage['stage'])
+            print(f"{rows:>10,}{args.clinics:>9}{stage['stage']:>28}"
+                  f"{stage['seconds']:>10.3f}{stage.get('rows_out', ''):>11}"
+                  f"{'' if baseline is None else f'{baseline:.3f}':>10}")
+        for stage, median, seconds in regressions:
+            print(f"回帰: rows={rows:,} {stage} {median:.3f}秒 → {seconds:.3f}秒")
+        regressed = regressed or bool(regressions)
+
+        history.append(record)
+        if args.history:
+            with open(args.history, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return regressed
+
+
+def _profile_memory(files, max_clinics_per_lot, top_n):
+    # 新しいプロセスで処理全体を1回実行し、工程ごとの最大RSSと結果の大きさを返す
+    # （最大RSSはプロセスの起動からの値のため、サイズごとにプロセスを分ける）
+    baseline_mb = instrumentation._rss_peak_mb()
+    with instrumentation.run('memory_profile') as report:
+        result_df = run_pipeline(files,
+                                 max_clinics_per_lot=max_clinics_per_lot,
+                                 top_n=top_n)
+    return {
+        'baseline_mb': baseline_mb,
+        'report': report.to_dict(),
+        'result_rows': len(result_df),
+        'result_mb': round(
+            result_df.memory_usage(deep=True).sum() / 1024 / 1024, 1),
+        'dtypes': {col: str(dtype) for col, dtype in result_df.dtypes.items()},
+    }
+
+
+def bench_memory(args):
+    # サイズごとに新しいプロセスで処理し、工程ごとの最大RSS（MB）と
+    # 結果の DataFrame のメモリ使用量を表示して、履歴（JSONL）と比較する
+    history = load_history(args.history)
+    revision = git_revision()
+    regressed = False
+    print(f"{'rows':>10}{'stage':>28}{'rss_peak_mb':>13}{'baseline':>10}")
+    for rows in args.sizes:
+        files = generate_sample_data.generate(inventory_rows=rows,
+                                              clinics=args.clinics,
+                                              seed=args.seed)
+        input_mb = round(sum(map(len, files.values())) / 1024 / 1024, 1)
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=get_context('spawn')) as executor:
+            profile = executor.submit(_profile_memory, files,
+                                      args.max_clinics_per_lot,
+                                      args.top_n).result()
+        report = profile['report']
+        params = {
+            'rows': rows,
+            'clinics': args.clinics,
+            'seed': args.seed,
+            'max_clinics_per_lot': args.max_clinics_per_lot,
+            'top_n': args.top_n,
+        }
+        record = {
+            'benchmark': 'memory',
+            'recorded_at': datetime.now().isoformat(timespec='seconds'),
+            'revision': revision,
+            'params': params,
+            'input_mb': input_mb,
+            'result_rows': profile['result_rows'],
+            'dtypes': profile['dtypes'],
+            'stages': {
+                'rss_peak_mb': report['rss_peak_mb'],
+                'rss_growth_mb': round(
+                    report['rss_peak_mb'] - profile['baseline_mb'], 1),
+                'result_mb': profile['result_mb'],
+            },
+        }
+        regressions = find_regressions(record, history, args.threshold)
+        baselines = {stage: median for stage, median, _ in regressions}
+
+        for stage in report['stages']:
+            print(f"{rows:>10,}{stage['stage']:>28}"
+                  f"{stage.get('rss_peak_mb', ''):>13}")
+        for stage, value in record['stages'].items():
+            baseline = baselines.get(stage)
+            print(f"{rows:>10,}{stage:>28}{value:>13}"
+                  f"{'' if baseline is None else baseline:>10}")
+        print(f"{rows:>10,}{'input_mb':>28}{input_mb:>13}")
+        for stage, median, value in regressions:
+            print(f"回帰: rows={rows:,} {stage} {median:.1f} MB → {value:.1f} MB")
+        regressed = regressed or bool(regressions)
+
+        history.append(record)
+        if args.history:
+            with open(args.history, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return regressed
+
+
+def bench_name_match(args):
+    # NAME_MATCH_CASES の薬品名を NAME_MATCH_MASTER と照合し、
+    # 期待と違う結果（別の薬品への照合を含む）があれば回帰として扱う
+    yj_master = pd.DataFrame({
+        '薬品名キー': FileProcessor.normalize_drug_name(
+            pd.Series(list(NAME_MATCH_MASTER))),
+        'ＹＪコード': list(NAME_MATCH_MASTER.values()),
+    })
+    names = [name for name, _ in NAME_MATCH_CASES]
+    matched = NameMatcher(yj_master).match(
+        FileProcessor.normalize_drug_name(pd.Series(names)))
+    regressed = False
+    print(f"{'name':<28}{'matched':<30}{'score':>7}")
+    for (name, expected), key, score in zip(NAME_MATCH_CASES,
+                                            matched['薬品名キー'],
+                                            matched['照合スコア']):
+        if expected is not None:
+            expected = FileProcessor.normalize_drug_name(
+                pd.Series([expected]))[0]
+        key = None if pd.isna(key) else key
+        print(f"{name:<28}{key or '-':<30}{score:>7.2f}")
+        if key != expected:
+            print(f"回帰: {name} の照合が {expected or 'なし'} ではなく {key or 'なし'}")
+            regressed = True
+    return regressed
+
+
+def bench_startup(args):
+    # 画面と同じくJSON形式のログ（INFO）を有効にした新しいプロセスで、
+    # STARTUP_MODULES を instrumentation.import_module で読み込んで所要時間を測る
+    # 読み込みやその記録のログ出力に失敗した場合も回帰として扱う
+    code = ('import json\n'
+            'import instrumentation\n'
+            'instrumentation.configure_logging("INFO")\n'
+            f'for name in {STARTUP_MODULES!r}:\n'
+            '    instrumentation.import_module(name)\n'
+            'print(json.dumps(instrumentation.startup_report()))\n')
+    completed = subprocess.run([sys.executable, '-c', code],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True,
+                               text=True)
+    logged = [
+        json.loads(line) for line in completed.stderr.splitlines()
+        if line.startswith('{')
+    ]
+    logged = {
+        entry.get('module_name')
+        for entry in logged if entry.get('event') == 'startup'
+    }
+    if completed.returncode != 0 or not set(STARTUP_MODULES) <= logged:
+        print(completed.stderr)
+        print("回帰: モジュールの読み込み（ログ出力を含む）に失敗")
+        return True
+
+    startup = json.loads(completed.stdout.splitlines()[-1])
+    history = load_history(args.history)
+    record = {
+        'benchmark': 'startup',
+        'recorded_at': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'params': {'modules': STARTUP_MODULES},
+        'rss_peak_mb': startup['rss_peak_mb'],
+        'stages': startup['imports'],
+    }
+    regressions = find_regressions(record, history, args.threshold)
+    baselines = {stage: median for stage, median, _ in regressions}
+    print(f"{'module':>28}{'seconds':>10}{'baseline':>10}")
+    for name, seconds in startup['imports'].items():
+        baseline = baselines.get(name)
+        print(f"{name:>28}{seconds:>10.3f}"
+              f"{'' if baseline is None else f'{baseline:.3f}':>10}")
+    for name, median, seconds in regressions:
+        print(f"回帰: {name} {median:.3f}秒 → {seconds:.3f}秒")
+
+    if args.history:
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return bool(regressions)
+
+
+BENCHMARKS = {
+    'encoding': bench_encoding,
+    'memory': bench_memory,
+    'name_match': bench_name_match,
+    'pipeline': bench_pipeline,
+    'startup': bench_startup,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FileProcessor のベンチマーク')
+    parser.add_argument('names',
+                        nargs='*',
+                        choices=sorted(BENCHMARKS),
+                        help='実行するベンチマーク（省略時はすべて）')
+    parser.add_argument('--sizes',
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        default=PIPELINE_SIZES,
+                        help='不良在庫の行数（カンマ区切り）')
+    parser.add_argument('--clinics', type=int, default=100, help='院所数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-clinics-per-lot',
+                        type=int,
+                        default=None,
+                        help='在庫1行あたりの候補院所数の上限')
+    parser.add_argument('--top-n',
+                        type=int,
+                        default=None,
+                        help='院所ごとに出力する優先度上位の件数')
+    parser.add_argument('--db',
+                        action='store_true',
+                        help='データベースへの保存も測る（PG* の環境変数が必要）')
+    parser.add_argument('--history',
+                        default='benchmark_history.jsonl',
+                        help='結果を追記する履歴ファイル（空文字で保存しない）')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=1.25,
+                        help='直近の中央値の何倍で回帰とみなすか')
+    args = parser.parse_args()
+    regressed = False
+    for name in args.names or sorted(BENCHMARKS):
+        regressed = BENCHMARKS[name](args) or regressed
+    # 回帰があった場合は終了コード 1（CI での検出用）
+    sys.exit(1 if regressed else 0)
@@ -1,20 +1,200 @@
+import io
+import logging
 import os
-import psycopg2
-from psycopg2.extras import DictCursor
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import instrumentation
+
+# psycopg2 は読み込みに時間がかかるため、各メソッドで使う時に読み込む
+# （最初の読み込みは warm_up のスレッドでプールを作る時。ログイン画面の表示を待たせない）
+
+# 在庫データの列 → inventory テーブルの列
+INVENTORY_TABLE_COLUMNS = {
+    'ＹＪコード': 'yj_code',
+    '薬品名': 'product_name',
+    '在庫量': 'quantity',
+    '使用期限': 'expiry_date',
+    'ロット番号': 'lot_number',
+}
+# COPY で一度に送る行数
+COPY_CHUNK_ROWS = 50000
+
+
+def lot_keys(inventory_df, pharmacy_id):
+    # 差分保存で使うロットの識別キー（ＹＪコード・ロット番号・使用期限・薬局から
+    # 作る64ビットのハッシュ）。ＹＪコードがない行は薬品名で代用し、
+    # 同じキーの行が複数ある場合はファイル内の出現順の番号で区別する
+    # pandas は読み込みに時間がかかるため、使う時に読み込む（画面の起動を速くする）
+    import pandas as pd
+
+    keys = pd.DataFrame({
+        'drug': inventory_df['ＹＪコード'].fillna(
+            inventory_df['薬品名']).astype(str),
+        'lot': inventory_df['ロット番号'].fillna('').astype(str),
+        'expiry': inventory_df['使用期限'].astype(str),
+        'pharmacy': str(pharmacy_id),
+    })
+    keys['occurrence'] = keys.groupby(list(keys.columns),
+                                      sort=False).cumcount()
+    hashed = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    return pd.Series(hashed.view('int64'), index=inventory_df.index)
+
+
+class ConnectionPool:
+    # プロセス全体で共有する、スレッドセーフで上限付きのコネクションプール
+    # 上限に達した場合は timeout 秒まで返却を待つ
+
+    def __init__(self, maxconn, timeout, ping_interval, **params):
+        self._params = params
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # (接続, 最後に返却された時刻) を新しい順に取り出す
+        self._idle = queue.LifoQueue()
+
+    def getconn(self):
+        import psycopg2
+        from psycopg2.pool import PoolError
+
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolError("データベース接続の空きがありません")
+        try:
+            while True:
+                try:
+                    conn, returned_at = self._idle.get_nowait()
+                except queue.Empty:
+                    return psycopg2.connect(**self._params)
+                if self._is_healthy(conn, returned_at):
+                    return conn
+                # 切断された接続は破棄して次の接続を試す
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        import psycopg2
+        from psycopg2 import extensions
+
+        try:
+            if not conn.closed and (conn.info.transaction_status !=
+                                    extensions.TRANSACTION_STATUS_IDLE):
+                conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        if not conn.closed:
+            self._idle.put((conn, time.monotonic()))
+        self._slots.release()
+
+    def _is_healthy(self, conn, returned_at):
+        import psycopg2
+
+        if conn.closed:
+            return False
+        # 一定時間使われていない接続だけ疎通を確認する
+        if time.monotonic() - returned_at < self._ping_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_schema_lock = threading.Lock()
+_schema_ready = False
+# warm_up はスキーマ作成中のロック（_schema_lock）を待たないよう別のロックを使う
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                maxconn=int(os.environ.get('DB_POOL_MAX', 10)),
+                timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+                ping_interval=float(os.environ.get('DB_POOL_PING_INTERVAL', 30)),
+                # 接続できない場合に、接続を待つ処理が止まり続けないようにする
+                connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
+                dbname=os.environ['PGDATABASE'],
+                user=os.environ['PGUSER'],
+                password=os.environ['PGPASSWORD'],
+                host=os.environ['PGHOST'],
+                port=os.environ['PGPORT']
+            )
+        return _pool
+
+
+def warm_up():
+    # 接続プールの作成とスキーマの作成をバックグラウンドで始める（プロセスで一度だけ）
+    # 完了前に Database を使った場合は、その処理が完了を待つ
+    # 画面の表示ごとに呼ばれるため、スキーマの作成中でも待たずに戻る
+    global _warm_up_thread
+    if _schema_ready:
+        return
+    with _warm_up_lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up_thread = threading.Thread(target=_warm_up,
+                                           name='db-warm-up',
+                                           daemon=True)
+        _warm_up_thread.start()
+
+
+def _warm_up():
+    # 失敗した場合も、次に Database を使う時にやり直す
+    try:
+        Database._ensure_schema()
+    except Exception:
+        logger.exception("データベースの準備中にエラーが発生")
+
 
 class Database:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            dbname=os.environ['PGDATABASE'],
-            user=os.environ['PGUSER'],
-            password=os.environ['PGPASSWORD'],
-            host=os.environ['PGHOST'],
-            port=os.environ['PGPORT']
-        )
-        self._create_tables()
+    # 接続はプロセス共有のプールから借りて使い、スキーマの作成は
+    # プロセスごとに一度、最初に接続する時に行う（warm_up で先に始められる）
+
+    @staticmethod
+    def _ensure_schema():
+        global _schema_ready
+        if not _schema_ready:
+            with _schema_lock:
+                if not _schema_ready:
+                    with instrumentation.stage('db.schema'):
+                        Database._create_tables()
+                    _schema_ready = True
+                    instrumentation.mark_startup('db_ready')
+
+    @staticmethod
+    @contextmanager
+    def _pooled_connection():
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
 
-    def _create_tables(self):
-        with self.conn.cursor() as cur:
+    @contextmanager
+    def _connection(self):
+        self._ensure_schema()
+        with self._pooled_connection() as conn:
+            yield conn
+
+    @staticmethod
+    def _create_tables():
+        with Database._pooled_connection() as conn, conn.cursor() as cur:
             # ユーザーテーブル
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS users (
@@ -37,10 +217,134 @@ class Database:
                     uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            self.conn.commit()
+
+            # アップロード単位のバッチ
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS upload_batches (
+                    id SERIAL PRIMARY KEY,
+                    pharmacy_id VARCHAR(100),
+                    row_count INTEGER,
+                    delta BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute("""
+                ALTER TABLE upload_batches
+                ADD COLUMN IF NOT EXISTS upload_key VARCHAR(200)
+            """)
+            # 同じアップロードでも、通常の保存と差分モードの保存は別のバッチ
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS upload_batches_upload_key_idx
+                ON upload_batches (pharmacy_id, upload_key, delta)
+            """)
+            cur.execute("""
+                ALTER TABLE inventory
+                ADD COLUMN IF NOT EXISTS lot_number VARCHAR(100),
+                ADD COLUMN IF NOT EXISTS batch_id INTEGER
+                    REFERENCES upload_batches (id)
+            """)
+
+            # 在庫データ検索用のインデックス
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS inventory_uploaded_at_idx
+                ON inventory (uploaded_at DESC, id DESC)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS inventory_yj_code_idx
+                ON inventory (yj_code)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS inventory_expiry_date_idx
+                ON inventory (expiry_date)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS inventory_batch_id_idx
+                ON inventory (batch_id)
+            """)
+            # 差分保存した在庫は lot_key ごとに1行（現在の状態）だけを持つ
+            cur.execute("""
+                ALTER TABLE inventory
+                ADD COLUMN IF NOT EXISTS lot_key BIGINT
+            """)
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS inventory_lot_key_idx
+                ON inventory (lot_key) WHERE lot_key IS NOT NULL
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS inventory_pharmacy_lot_idx
+                ON inventory (pharmacy_id) WHERE lot_key IS NOT NULL
+            """)
+
+            # 在庫金額マスター（薬品名→ＹＪコード・単位・単価）のキャッシュ
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS yj_master_versions (
+                    content_hash VARCHAR(64) PRIMARY KEY,
+                    row_count INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS yj_master_entries (
+                    content_hash VARCHAR(64) NOT NULL
+                        REFERENCES yj_master_versions (content_hash)
+                        ON DELETE CASCADE,
+                    drug_key TEXT NOT NULL,
+                    yj_code VARCHAR(100),
+                    unit VARCHAR(100),
+                    unit_price DOUBLE PRECISION
+                )
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS yj_master_entries_hash_idx
+                ON yj_master_entries (content_hash)
+            """)
+
+            # アップロード処理のジョブ（状態・各工程の所要時間・結果のExcel）
+            # claim_token は実行中のワーカーの識別子、heartbeat_at はその最後の生存の記録
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id SERIAL PRIMARY KEY,
+                    pharmacy_id VARCHAR(100),
+                    upload_key VARCHAR(200),
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    error TEXT,
+                    batch_id INTEGER REFERENCES upload_batches (id),
+                    timings JSONB,
+                    result BYTEA,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    claim_token VARCHAR(32),
+                    heartbeat_at TIMESTAMP
+                )
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS jobs_status_idx
+                ON jobs (status, id)
+            """)
+            cur.execute("""
+                ALTER TABLE jobs
+                ADD COLUMN IF NOT EXISTS delta BOOLEAN NOT NULL DEFAULT FALSE
+            """)
+            # ジョブの入力ファイル（処理が終わったら削除する）
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id INTEGER NOT NULL
+                        REFERENCES jobs (id) ON DELETE CASCADE,
+                    role VARCHAR(50) NOT NULL,
+                    file_name VARCHAR(255),
+                    content BYTEA NOT NULL,
+                    PRIMARY KEY (job_id, role)
+                )
+            """)
+            conn.commit()
 
     def verify_user(self, username, password_hash):
-        with self.conn.cursor(cursor_factory=DictCursor) as cur:
+        from psycopg2.extras import DictCursor
+
+        with self._connection() as conn, \
+                conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute(
                 "SELECT * FROM users WHERE username = %s AND password_hash = %s",
                 (username, password_hash)
@@ -48,28 +352,458 @@ class Database:
             return cur.fetchone()
 
     def create_user(self, username, password_hash):
+        import psycopg2
+
         try:
-            with self.conn.cursor() as cur:
+            with self._connection() as conn, conn.cursor() as cur:
                 cur.execute(
                     "INSERT INTO users (username, password_hash) VALUES (%s, %s)",
                     (username, password_hash)
                 )
-                self.conn.commit()
+                conn.commit()
                 return True
         except psycopg2.Error:
-            self.conn.rollback()
             return False
 
-    def save_inventory(self, inventory_data):
-        with self.conn.cursor() as cur:
-            cur.executemany("""
-                INSERT INTO inventory 
-                (yj_code, product_name, quantity, expiry_date, pharmacy_id)
-                VALUES (%s, %s, %s, %s, %s)
-            """, inventory_data)
-            self.conn.commit()
-
-    def get_inventory(self):
-        with self.conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM inventory ORDER BY uploaded_at DESC")
-            return cur.fetchall()
+    @staticmethod
+    def _create_batch(cur, pharmacy_id, row_count, upload_key, delta):
+        # アップロードのバッチを作成し、(バッチID, 作成したか) を返す
+        # 同じ薬局・同じキー・同じ保存方法（通常/差分）のバッチがあればそのIDを返す
+        cur.execute(
+            "INSERT INTO upload_batches "
+            "(pharmacy_id, row_count, upload_key, delta) "
+            "VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (pharmacy_id, upload_key, delta) DO NOTHING "
+            "RETURNING id",
+            (pharmacy_id, row_count, upload_key, delta)
+        )
+        row = cur.fetchone()
+        if row is not None:
+            return row[0], True
+        cur.execute(
+            "SELECT id FROM upload_batches "
+            "WHERE pharmacy_id = %s AND upload_key = %s AND delta = %s",
+            (pharmacy_id, upload_key, delta)
+        )
+        return cur.fetchone()[0], False
+
+    def save_inventory(self, inventory_df, pharmacy_id=None, upload_key=None):
+        # 在庫データ（process_data の return_inventory=True で得られるもの）を
+        # COPY でまとめて保存する。1つのトランザクションで保存し、
+        # アップロードのバッチIDを返す
+        # upload_key（アップロードファイルのハッシュ）を渡した場合、同じ薬局・
+        # 同じキーのデータは一度だけ保存し、2回目以降は既存のバッチIDを返す
+        # （差分モードで保存したバッチとは別に扱う）
+        columns = list(INVENTORY_TABLE_COLUMNS)
+        copy_sql = """
+            COPY inventory ({}, pharmacy_id, batch_id)
+            FROM STDIN WITH (FORMAT csv)
+        """.format(', '.join(INVENTORY_TABLE_COLUMNS.values()))
+
+        with instrumentation.stage('db.save', rows_in=len(inventory_df)) as metrics, \
+                self._connection() as conn, conn.cursor() as cur:
+            batch_id, created = self._create_batch(cur, pharmacy_id,
+                                                   len(inventory_df),
+                                                   upload_key, delta=False)
+            if not created:
+                metrics['skipped'] = True
+                return batch_id
+
+            # 行ごとのリストを作らず、一定行数ずつCSVに書き出して送る
+            for start in range(0, len(inventory_df), COPY_CHUNK_ROWS):
+                chunk = inventory_df.iloc[start:start + COPY_CHUNK_ROWS]
+                chunk = chunk[columns].assign(pharmacy_id=pharmacy_id,
+                                              batch_id=batch_id)
+                buffer = io.StringIO()
+                chunk.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cur.copy_expert(copy_sql, buffer)
+            conn.commit()
+            metrics['rows_out'] = len(inventory_df)
+            return batch_id
+
+    def save_inventory_delta(self, inventory_df, pharmacy_id, upload_key=None):
+        # 薬局の在庫を、前回の差分保存との差分だけ更新する（差分モード）
+        # ロットは lot_keys で識別し、新しいロットは追加、在庫量・薬品名が
+        # 変わったロットは更新、今回のファイルにないロットは削除する
+        # 件数（inserted, updated, deleted, unchanged）とバッチIDを返す
+        columns = list(INVENTORY_TABLE_COLUMNS)
+        table_columns = ', '.join(INVENTORY_TABLE_COLUMNS.values())
+        delta = {
+            'batch_id': None,
+            'rows': len(inventory_df),
+            'inserted': 0,
+            'updated': 0,
+            'deleted': 0,
+            'unchanged': 0,
+        }
+
+        with instrumentation.stage('db.save_delta',
+                                   rows_in=len(inventory_df)) as metrics, \
+                self._connection() as conn, conn.cursor() as cur:
+            batch_id, created = self._create_batch(cur, pharmacy_id,
+                                                   len(inventory_df),
+                                                   upload_key, delta=True)
+            delta['batch_id'] = batch_id
+            if not created:
+                # 同じアップロードは差分モードで反映済み
+                delta['unchanged'] = len(inventory_df)
+                metrics.update(delta)
+                return delta
+
+            # 今回のファイルの在庫を一時テーブルに COPY してから、SQL で比較する
+            cur.execute("""
+                CREATE TEMP TABLE inventory_stage (
+                    lot_key BIGINT,
+                    yj_code VARCHAR(100),
+                    product_name VARCHAR(200),
+                    quantity INTEGER,
+                    expiry_date DATE,
+                    lot_number VARCHAR(100)
+                ) ON COMMIT DROP
+            """)
+            import pandas as pd
+
+            keys = lot_keys(inventory_df, pharmacy_id)
+            copy_sql = f"""
+                COPY inventory_stage (lot_key, {table_columns})
+                FROM STDIN WITH (FORMAT csv)
+            """
+            for start in range(0, len(inventory_df), COPY_CHUNK_ROWS):
+                chunk = inventory_df.iloc[start:start + COPY_CHUNK_ROWS]
+                chunk = pd.concat(
+                    [keys.iloc[start:start + COPY_CHUNK_ROWS], chunk[columns]],
+                    axis=1)
+                buffer = io.StringIO()
+                chunk.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cur.copy_expert(copy_sql, buffer)
+            cur.execute("ANALYZE inventory_stage")
+
+            # 追加と更新（内容が同じロットは更新しない）
+            cur.execute(f"""
+                WITH upserted AS (
+                    INSERT INTO inventory
+                        (lot_key, {table_columns}, pharmacy_id, batch_id)
+                    SELECT lot_key, {table_columns}, %s, %s
+                    FROM inventory_stage
+                    ON CONFLICT (lot_key) WHERE lot_key IS NOT NULL
+                    DO UPDATE SET
+                        product_name = EXCLUDED.product_name,
+                        quantity = EXCLUDED.quantity,
+                        batch_id = EXCLUDED.batch_id,
+                        uploaded_at = CURRENT_TIMESTAMP
+                    WHERE (inventory.product_name, inventory.quantity)
+                        IS DISTINCT FROM
+                        (EXCLUDED.product_name, EXCLUDED.quantity)
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted),
+                       count(*) FILTER (WHERE NOT inserted)
+                FROM upserted
+            """, (pharmacy_id, batch_id))
+            delta['inserted'], delta['updated'] = cur.fetchone()
+
+            # 今回のファイルにないロットを削除
+            cur.execute("""
+                DELETE FROM inventory i
+                WHERE i.pharmacy_id = %s AND i.lot_key IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM inventory_stage s
+                      WHERE s.lot_key = i.lot_key)
+            """, (pharmacy_id,))
+            delta['deleted'] = cur.rowcount
+            delta['unchanged'] = (len(inventory_df) - delta['inserted'] -
+                                  delta['updated'])
+            conn.commit()
+            metrics.update(delta)
+            return delta
+
+    def get_upload_batches(self, pharmacy_id, limit=20):
+        # 薬局のアップロードのバッチを新しい順に返す
+        from psycopg2.extras import DictCursor
+
+        with self._connection() as conn, \
+                conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                "SELECT id, row_count, upload_key, delta, created_at "
+                "FROM upload_batches WHERE pharmacy_id = %s "
+                "ORDER BY created_at DESC, id DESC LIMIT %s",
+                (pharmacy_id, limit)
+            )
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+
+    @staticmethod
+    def _inventory_filters(yj_code=None,
+                           pharmacy_id=None,
+                           expiry_from=None,
+                           expiry_to=None,
+                           batch_id=None):
+        # 在庫データ検索の WHERE 句とパラメータを作る
+        conditions = []
+        params = []
+        for condition, value in [("yj_code = %s", yj_code),
+                                 ("pharmacy_id = %s", pharmacy_id),
+                                 ("expiry_date >= %s", expiry_from),
+                                 ("expiry_date <= %s", expiry_to),
+                                 ("batch_id = %s", batch_id)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return conditions, params
+
+    def get_inventory(self, after=None, limit=100, **filters):
+        # 在庫データを新しい順に1ページ分返す（キーセット方式のページング）
+        # 次のページは、戻り値の next_key を after に渡して取得する
+        # filters: yj_code, pharmacy_id, expiry_from, expiry_to, batch_id
+        from psycopg2.extras import DictCursor
+
+        conditions, params = self._inventory_filters(**filters)
+        if after is not None:
+            conditions.append("(uploaded_at, id) < (%s, %s)")
+            params.extend(after)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+        with self._connection() as conn, \
+                conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(f"""
+                SELECT * FROM inventory {where}
+                ORDER BY uploaded_at DESC, id DESC
+                LIMIT %s
+            """, params + [limit])
+            rows = cur.fetchall()
+
+        next_key = None
+        if len(rows) == limit:
+            next_key = (rows[-1]['uploaded_at'], rows[-1]['id'])
+        return rows, next_key
+
+    def iter_inventory(self, itersize=2000, **filters):
+        # 条件に合う在庫データを、名前付き（サーバーサイド）カーソルで
+        # itersize 行ずつ取得しながら返す
+        from psycopg2.extras import DictCursor
+
+        conditions, params = self._inventory_filters(**filters)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+        with self._connection() as conn, \
+                conn.cursor(name='inventory_stream',
+                            cursor_factory=DictCursor) as cur:
+            cur.itersize = itersize
+            cur.execute(f"""
+                SELECT * FROM inventory {where}
+                ORDER BY uploaded_at DESC, id DESC
+            """, params)
+            yield from cur
+
+    def get_yj_master(self, content_hash):
+        # キャッシュ済みのマスターを取得し、最終利用日時を更新する
+        import psycopg2
+
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE yj_master_versions "
+                    "SET last_used_at = CURRENT_TIMESTAMP "
+                    "WHERE content_hash = %s",
+                    (content_hash,)
+                )
+                if cur.rowcount == 0:
+                    conn.commit()
+                    return None
+                cur.execute(
+                    "SELECT drug_key, yj_code, unit, unit_price "
+                    "FROM yj_master_entries "
+                    "WHERE content_hash = %s",
+                    (content_hash,)
+                )
+                rows = cur.fetchall()
+                conn.commit()
+                return rows
+        except psycopg2.Error:
+            return None
+
+    def save_yj_master(self, content_hash, entries, keep_versions=5):
+        # マスターを保存し、最近使われていない古い版を削除する（LRU）
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO yj_master_versions (content_hash, row_count) "
+                    "VALUES (%s, %s) ON CONFLICT (content_hash) DO NOTHING",
+                    (content_hash, len(entries))
+                )
+                if cur.rowcount:
+                    execute_values(cur, """
+                        INSERT INTO yj_master_entries
+                        (content_hash, drug_key, yj_code, unit, unit_price)
+                        VALUES %s
+                    """, [(content_hash, ) + tuple(entry) for entry in entries],
+                        page_size=1000)
+                cur.execute("""
+                    DELETE FROM yj_master_versions
+                    WHERE content_hash IN (
+                        SELECT content_hash FROM yj_master_versions
+                        ORDER BY last_used_at DESC
+                        OFFSET %s
+                    )
+                """, (keep_versions,))
+                conn.commit()
+                return True
+        except psycopg2.Error:
+            return False
+
+    def create_job(self, pharmacy_id, upload_key, files, delta=False):
+        # ジョブと入力ファイル（{役割: (ファイル名, バイト列)}）を登録してIDを返す
+        # 同じ薬局・同じキー・同じモードの未失敗のジョブがあれば、そのIDを返す
+        # delta=True の場合は在庫を差分モード（save_inventory_delta）で保存する
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT id FROM jobs "
+                "WHERE pharmacy_id = %s AND upload_key = %s AND delta = %s "
+                "AND status <> 'failed' ORDER BY id DESC LIMIT 1",
+                (pharmacy_id, upload_key, delta)
+            )
+            row = cur.fetchone()
+            if row is not None:
+                conn.commit()
+                return row[0]
+
+            cur.execute(
+                "INSERT INTO jobs (pharmacy_id, upload_key, delta) "
+                "VALUES (%s, %s, %s) RETURNING id",
+                (pharmacy_id, upload_key, delta)
+            )
+            job_id = cur.fetchone()[0]
+            execute_values(cur, """
+                INSERT INTO job_files (job_id, role, file_name, content) VALUES %s
+            """, [(job_id, role, name, psycopg2.Binary(content))
+                  for role, (name, content) in files.items()])
+            conn.commit()
+            return job_id
+
+    def claim_job(self, stale_seconds=300):
+        # 待機中のジョブを1件取り出して実行中にする（なければ None）
+        # 生存の記録（heartbeat_job）が stale_seconds 以上途絶えた実行中のジョブ
+        # （停止したプロセスのもの）も取り出し直す。SKIP LOCKED で複数のワーカーが
+        # 同じジョブを取らない。返す claim_token は取り出しごとに新しくなり、
+        # heartbeat_job・finish_job・fail_job は取り出したワーカーからだけ受け付ける
+        from psycopg2.extras import DictCursor
+
+        with self._connection() as conn, \
+                conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                UPDATE jobs
+                SET status = 'running', started_at = CURRENT_TIMESTAMP,
+                    heartbeat_at = CURRENT_TIMESTAMP, claim_token = %s
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued'
+                       OR (status = 'running' AND heartbeat_at <
+                           CURRENT_TIMESTAMP - make_interval(secs => %s))
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, pharmacy_id, upload_key, delta, claim_token
+            """, (uuid.uuid4().hex, stale_seconds))
+            job = cur.fetchone()
+            conn.commit()
+            return job
+
+    def heartbeat_job(self, job_id, claim_token):
+        # 実行中のジョブの生存を記録する
+        # 別のワーカーに取り出し直された場合などは False を返す
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s AND status = 'running' AND claim_token = %s",
+                (job_id, claim_token)
+            )
+            claimed = cur.rowcount == 1
+            conn.commit()
+        return claimed
+
+    def get_job_files(self, job_id):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT role, file_name, content FROM job_files "
+                "WHERE job_id = %s",
+                (job_id,)
+            )
+            rows = cur.fetchall()
+            conn.commit()
+        return {role: (name, bytes(content)) for role, name, content in rows}
+
+    def finish_job(self, job_id, claim_token, result, timings, batch_id=None):
+        # 結果のExcelと所要時間を保存し、入力ファイルを削除する
+        # ジョブを取り出したワーカーでなくなっていた場合は何もせず False を返す
+        import psycopg2
+        from psycopg2.extras import Json
+
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE jobs SET status = 'done', result = %s, timings = %s, "
+                "batch_id = %s, finished_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s AND status = 'running' AND claim_token = %s",
+                (psycopg2.Binary(result), Json(timings), batch_id, job_id,
+                 claim_token)
+            )
+            claimed = cur.rowcount == 1
+            if claimed:
+                cur.execute("DELETE FROM job_files WHERE job_id = %s",
+                            (job_id,))
+            conn.commit()
+        return claimed
+
+    def fail_job(self, job_id, claim_token, error, timings):
+        # ジョブを取り出したワーカーでなくなっていた場合は何もせず False を返す
+        from psycopg2.extras import Json
+
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE jobs SET status = 'failed', error = %s, timings = %s, "
+                "finished_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s AND status = 'running' AND claim_token = %s",
+                (error, Json(timings), job_id, claim_token)
+            )
+            claimed = cur.rowcount == 1
+            if claimed:
+                cur.execute("DELETE FROM job_files WHERE job_id = %s",
+                            (job_id,))
+            conn.commit()
+        return claimed
+
+    def get_job(self, job_id):
+        # ジョブの状態を返す（結果のExcelは含まない）
+        from psycopg2.extras import DictCursor
+
+        with self._connection() as conn, \
+                conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, pharmacy_id, upload_key, delta, status, error,
+                       batch_id, timings, created_at, started_at, finished_at,
+                       EXTRACT(EPOCH FROM
+                               COALESCE(finished_at, LOCALTIMESTAMP) -
+                               started_at) AS elapsed
+                FROM jobs WHERE id = %s
+            """, (job_id,))
+            job = cur.fetchone()
+            conn.commit()
+            return job
+
+    def get_job_result(self, job_id):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT result FROM jobs WHERE id = %s", (job_id,))
+            row = cur.fetchone()
+            conn.commit()
+        if row is None or row[0] is None:
+            return None
+        return bytes(row[0])
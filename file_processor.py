@@ -1,16 +1,145 @@
 import pandas as pd
+import numpy as np
 import chardet
+import codecs
+import hashlib
+import importlib.util
 import io
+import logging
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
 from datetime import datetime
-from openpyxl.styles import Border, Side
+from multiprocessing import get_context
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.styles.fonts import DEFAULT_FONT
+from pandas.tseries.api import guess_datetime_format
+
+import instrumentation
+
+# python-calamine がある場合は Excel の読み込みに calamine を使う
+HAS_CALAMINE = importlib.util.find_spec('python_calamine') is not None
+# pyarrow がある場合は、重複の少ない文字列の列（薬品名・ロット番号）を
+# pyarrow の文字列型で持つ（ない場合は Python の文字列）
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+STRING_DTYPE = 'string[pyarrow]' if HAS_PYARROW else str
+
+logger = logging.getLogger(__name__)
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def get_process_pool(max_workers):
+    # 並列処理用のプロセスプール（max_workers ごとにプロセスで1つ作り、使い回す）
+    # Streamlit のサーバーはスレッドを使うため、fork ではなく spawn で起動する
+    # （fork では他のスレッドが持っていたロックもそのままコピーされ、
+    # 子プロセスが止まることがある）
+    with _process_pools_lock:
+        pool = _process_pools.get(max_workers)
+        # 子プロセスが異常終了したプールは使えないため作り直す
+        if pool is None or pool._broken:
+            pool = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=get_context('spawn'))
+            _process_pools[max_workers] = pool
+        return pool
 
 
 class FileProcessor:
 
+    # 院所別シートのヘッダー部分（1～6行目）
+    EXCEL_TITLE = '不良在庫引き取り依頼'
+    EXCEL_MESSAGE = '下記の不良在庫につきまして、引き取りのご検討を賜れますと幸いです。どうぞよろしくお願いいたします。'
+
+    # 文字コード判定で試すエンコーディング（実際に受け取るもの）と標本の大きさ
+    CANDIDATE_ENCODINGS = ['utf-8', 'cp932', 'euc_jp']
+    ENCODING_SAMPLE_SIZE = 64 * 1024
+    # 不良在庫CSVの前置き行数・使用する列・分割読み込みの行数
+    INVENTORY_PREAMBLE_ROWS = 7
+    INVENTORY_COLUMNS = ['薬品名', '在庫量', '使用期限', 'ロット番号']
+    INVENTORY_CHUNK_SIZE = 50000
+
+    # 購入履歴（OMEC他院所）で使う列
+    PURCHASE_COLUMNS = ['厚労省CD', '法人名', '院所名', '品名・規格', '新薬品ｺｰﾄﾞ']
+    # 購入履歴の集計に使う列（ファイルにある場合のみ使用）
+    PURCHASE_DATE_COLUMN = '購入日'
+    PURCHASE_QUANTITY_COLUMN = '数量'
+
+    # process_data が返す列
+    RESULT_COLUMNS = [
+        '品名・規格', '在庫量', '単位', '新薬品ｺｰﾄﾞ', '使用期限', 'ロット番号', '法人名', '院所名'
+    ]
+    # 複数の薬局の在庫をまとめて処理する場合に、在庫の元の薬局を示す列
+    # （在庫データにある場合は結果にも含める）
+    SOURCE_COLUMN = '薬局'
+
+    CHARDET_ALIASES = {
+        'utf-8': 'utf-8',
+        'shift_jis': 'cp932',
+        'cp932': 'cp932',
+        'euc-jp': 'euc_jp',
+    }
+
+    @staticmethod
+    def content_hash(file):
+        # アップロードされたファイル内容のハッシュ（キャッシュのキー）
+        with file.getbuffer() as file_bytes:
+            return hashlib.sha256(file_bytes).hexdigest()
+
     @staticmethod
     def detect_encoding(file_bytes):
-        result = chardet.detect(file_bytes)
-        return result['encoding']
+        encoding, _ = FileProcessor.detect_encoding_with_confidence(file_bytes)
+        return encoding
+
+    @staticmethod
+    def detect_encoding_with_confidence(file_bytes):
+        # 文字コードと信頼度を返す。ファイル全体ではなく先頭の標本だけを見る
+        # （file_bytes は bytes のほか memoryview も受け付ける）
+        # 1. BOM
+        for bom, encoding in [(codecs.BOM_UTF8, 'utf-8-sig'),
+                              (codecs.BOM_UTF16_LE, 'utf-16'),
+                              (codecs.BOM_UTF16_BE, 'utf-16')]:
+            if file_bytes[:len(bom)] == bom:
+                return encoding, 1.0
+
+        # 2. 最初の非ASCIIバイトから一定量を標本とする
+        match = re.search(rb'[\x80-\xff]', file_bytes)
+        if match is None:
+            return 'utf-8', 1.0
+        sample = bytes(file_bytes[match.start():match.start() +
+                                  FileProcessor.ENCODING_SAMPLE_SIZE])
+
+        # 3. 候補のエンコーディングで厳密にデコードできるか試す
+        # （標本の末尾で切れた文字はエラーにしない）
+        decodable = []
+        for encoding in FileProcessor.CANDIDATE_ENCODINGS:
+            decoder = codecs.getincrementaldecoder(encoding)(errors='strict')
+            try:
+                decoder.decode(sample, final=False)
+            except UnicodeDecodeError:
+                continue
+            decodable.append(encoding)
+
+        if len(decodable) == 1 or decodable[:1] == ['utf-8']:
+            return decodable[0], 0.99
+
+        # 4. 判別できない場合のみ、標本に対して chardet を使う
+        result = chardet.detect(sample)
+        guess = FileProcessor.CHARDET_ALIASES.get(
+            (result['encoding'] or '').lower())
+        if guess in decodable:
+            return guess, result['confidence']
+        if decodable:
+            # chardet の結果がデコードできない場合は候補の先頭を採用する
+            return decodable[0], 1.0 / len(decodable)
+        if result['encoding']:
+            return result['encoding'], result['confidence']
+        return 'cp932', 0.0
 
     @staticmethod
     def read_excel(file):
@@ -21,141 +150,561 @@ class FileProcessor:
             raise Exception(f"Excelファイルの読み込みエラー: {str(e)}")
 
     @staticmethod
-    def read_csv(file, file_type='default'):
+    def _read_excel_columns(file, columns):
+        # openpyxl の読み取り専用モードで、先頭シートの指定した列
+        # （存在するもの）だけを取り出す
+        workbook = load_workbook(file, read_only=True, data_only=True)
         try:
-            file_bytes = file.getvalue()
-            encoding = FileProcessor.detect_encoding(file_bytes)
+            worksheet = workbook.worksheets[0]
+            header = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+            columns = [col for col in columns if col in header]
+            if not columns:
+                return pd.DataFrame()
+            positions = [header.index(col) for col in columns]
+            rows = worksheet.iter_rows(min_row=2,
+                                       max_col=max(positions) + 1,
+                                       values_only=True)
+            data = [[row[pos] if pos < len(row) else None for pos in positions]
+                    for row in rows]
+        finally:
+            workbook.close()
+        return pd.DataFrame(data, columns=columns,
+                            dtype=object).dropna(how='all')
 
-            if file_type == 'inventory':
-                # 不良在庫データの場合、最初の7行をスキップ
-                df = pd.read_csv(io.BytesIO(file_bytes),
-                                 encoding=encoding,
-                                 skiprows=7)
+    @staticmethod
+    def read_purchase_history(file,
+                              columns=None,
+                              optional_columns=(),
+                              dedupe=True,
+                              cache_dir=None):
+        # OMEC他院所ファイルから必要な列（既定は PURCHASE_COLUMNS）だけを読み込む
+        # optional_columns の列はファイルにある場合だけ読み込む
+        # python-calamine があれば calamine で、なければ openpyxl の
+        # 読み取り専用モードで読み込む
+        # dedupe=True の場合は、必要な列がすべて同じ行を読み込み時に除く
+        # cache_dir を指定すると結果を Parquet で保存して再利用する（pyarrow が必要）
+        columns = list(columns or FileProcessor.PURCHASE_COLUMNS)
+        try:
+            with instrumentation.stage('ingest.purchase_history') as metrics:
+                cache_path = None
+                if cache_dir:
+                    options = '\0'.join(columns + ['|'] +
+                                         list(optional_columns) +
+                                         [str(dedupe)])
+                    cache_path = os.path.join(
+                        cache_dir, '{}-{}.parquet'.format(
+                            FileProcessor.content_hash(file),
+                            hashlib.sha256(options.encode()).hexdigest()[:16]))
+                    if os.path.exists(cache_path):
+                        df = pd.read_parquet(cache_path)
+                        metrics.update(rows_out=len(df), cache='hit')
+                        return df
 
-                # デバッグ用：元のデータ行数を記録
-                print(f"読み込み直後の行数: {len(df)}")
+                # コード・名称の列は文字列として読み込む
+                text_columns = [
+                    col for col in columns
+                    if col in FileProcessor.PURCHASE_COLUMNS
+                ]
+                wanted = columns + [
+                    col for col in optional_columns if col not in columns
+                ]
+                file.seek(0)
+                if HAS_CALAMINE:
+                    df = pd.read_excel(file,
+                                       engine='calamine',
+                                       usecols=lambda col: col in wanted,
+                                       dtype={col: str
+                                              for col in text_columns})
+                else:
+                    df = FileProcessor._read_excel_columns(file, wanted)
 
-                # 薬品名が空白の行を削除（より厳密なチェック）
-                # NaN, None, 空文字、空白文字をすべて除外
-                df['薬品名'] = df['薬品名'].astype(str).apply(lambda x: x.strip())
-                df = df[df['薬品名'].apply(
-                    lambda x: x not in ['', 'nan', 'None'])]
+                missing = [col for col in columns if col not in df.columns]
+                if missing:
+                    raise KeyError(f"列が見つかりません: {', '.join(missing)}")
+                df = df[[col for col in wanted if col in df.columns]]
+                # コード・名称は同じ値が繰り返されるため、カテゴリ型で持つ
+                for col in text_columns:
+                    df[col] = FileProcessor.to_category(df[col])
 
-                # デバッグ用：薬品名フィルタリング後の行数を記録
-                print(f"薬品名フィルタリング後の行数: {len(df)}")
+                if dedupe:
+                    df = df.drop_duplicates(ignore_index=True)
+                metrics['rows_out'] = len(df)
 
-                # 在庫量を数値に変換し、0以下の行を削除
-                df['在庫量'] = pd.to_numeric(df['在庫量'], errors='coerce')
-                df = df[df['在庫量'] > 0]
+                if cache_path:
+                    try:
+                        os.makedirs(cache_dir, exist_ok=True)
+                        df.to_parquet(cache_path, index=False)
+                    except ImportError:
+                        # Parquet のエンジンがない場合はキャッシュしない
+                        pass
+                return df
+        except Exception as e:
+            raise Exception(f"Excelファイルの読み込みエラー: {str(e)}")
 
-                # デバッグ用：在庫量フィルタリング後の行数を記録
-                print(f"在庫量フィルタリング後の行数: {len(df)}")
+    @staticmethod
+    def read_csv(file, file_type='default'):
+        try:
+            file_bytes = file.getvalue()
+            encoding = FileProcessor._detect_encoding_stage(file_bytes)
 
-                # 在庫量を整数に変換
-                df['在庫量'] = df['在庫量'].astype(int)
-            else:
-                df = pd.read_csv(io.BytesIO(file_bytes), encoding=encoding)
+            with instrumentation.stage('ingest.csv') as metrics:
+                if file_type == 'inventory':
+                    # 不良在庫データの場合、最初の7行をスキップ
+                    df = pd.read_csv(
+                        io.BytesIO(file_bytes),
+                        encoding=encoding,
+                        skiprows=FileProcessor.INVENTORY_PREAMBLE_ROWS)
+                else:
+                    df = pd.read_csv(io.BytesIO(file_bytes), encoding=encoding)
+                metrics['rows_out'] = len(df)
+
+            if file_type == 'inventory':
+                df = FileProcessor._filter_drug_names(df)
+                df = FileProcessor._filter_quantity(df)
 
             return df
         except Exception as e:
             raise Exception(f"CSVファイルの読み込みエラー: {str(e)}")
 
     @staticmethod
-    def process_data(purchase_history_df, inventory_df, yj_code_df):
+    def _detect_encoding_stage(file_bytes):
+        with instrumentation.stage('ingest.encoding') as metrics:
+            encoding, confidence = (
+                FileProcessor.detect_encoding_with_confidence(file_bytes))
+            metrics.update(encoding=encoding, confidence=round(confidence, 2))
+        return encoding
+
+    @staticmethod
+    def _filter_drug_names(df):
+        # 薬品名が空白の行を削除（より厳密なチェック）
+        # NaN, None, 空文字、空白文字をすべて除外
+        # df は読み込んだばかりのものを渡す（列を置き換えてから行を取り出すため、
+        # 行の取り出しによるコピーは1回だけ）
+        with instrumentation.stage('ingest.drug_name_filter',
+                                   rows_in=len(df)) as metrics:
+            names = df['薬品名'].astype(STRING_DTYPE, copy=False).str.strip()
+            keep = names.notna() & ~names.isin(['', 'nan', 'None'])
+            df['薬品名'] = names
+            df = df.take(np.flatnonzero(keep.to_numpy(dtype=bool,
+                                                      na_value=False)))
+            metrics['rows_out'] = len(df)
+        return df
+
+    @staticmethod
+    def _filter_quantity(df):
+        # 在庫量を数値に変換し、0以下の行を削除して整数に変換
+        with instrumentation.stage('ingest.quantity_filter',
+                                   rows_in=len(df)) as metrics:
+            quantity = pd.to_numeric(df['在庫量'], errors='coerce')
+            keep = (quantity > 0).to_numpy()
+            df['在庫量'] = quantity.fillna(0).astype(np.int64)
+            df = df.take(np.flatnonzero(keep))
+            metrics['rows_out'] = len(df)
+        return df
+
+    @staticmethod
+    def iter_inventory_chunks(file, chunksize=None):
+        # 不良在庫CSVを chunksize 行ずつ読み込み、フィルタリング済みのチャンクを返す
+        # 必要な列だけを読み込むため、ピークメモリはファイルサイズではなく
+        # チャンクサイズで決まる
         try:
-            print("データ処理開始")
-            print(
-                f"入力データの行数: 購入履歴={len(purchase_history_df)}, 在庫={len(inventory_df)}, YJコード={len(yj_code_df)}"
-            )
-
-            # データの前処理と検証
-            # 空の薬品名を持つ行を削除
-            inventory_df = inventory_df[inventory_df['薬品名'].notna() & (
-                inventory_df['薬品名'].str.strip() != '')]
-            print(f"薬品名フィルタリング後の在庫データ行数: {len(inventory_df)}")
-
-            # 在庫量のバリデーション
-            inventory_df['在庫量'] = pd.to_numeric(inventory_df['在庫量'],
-                                                errors='coerce')
-            inventory_df = inventory_df[inventory_df['在庫量'] > 0]
-            print(f"在庫量バリデーション後の行数: {len(inventory_df)}")
-
-            # 使用期限のフォーマットチェックと変換
-            inventory_df['使用期限'] = pd.to_datetime(inventory_df['使用期限'],
-                                                  errors='coerce')
-            inventory_df = inventory_df[inventory_df['使用期限'].notna()]
-            print(f"使用期限バリデーション後の行数: {len(inventory_df)}")
-
-            # 数値データを文字列に変換し、NaN値を処理
-            for df in [inventory_df, purchase_history_df, yj_code_df]:
-                for col in df.columns:
-                    df[col] = df[col].fillna('').astype(str)
-
-            # 在庫金額CSVから薬品名とＹＪコードのマッピングを作成
-            yj_mapping = dict(
-                zip(yj_code_df['薬品名'],
-                    zip(yj_code_df['ＹＪコード'], yj_code_df['単位'])))
-            print(f"YJコードマッピング数: {len(yj_mapping)}")
-
-            # 不良在庫データに対してＹＪコードと単位を設定
-            inventory_df['ＹＪコード'] = inventory_df['薬品名'].map(
-                lambda x: yj_mapping.get(x.strip(), (None, None))[0])
-            inventory_df['単位'] = inventory_df['薬品名'].map(
-                lambda x: yj_mapping.get(x.strip(), (None, None))[1])
-
-            # マッピング結果の確認
-            mapped_count = inventory_df['ＹＪコード'].notna().sum()
-            print(f"YJコードマッピング成功数: {mapped_count}/{len(inventory_df)}")
-
-            # ＹＪコードと厚労省CDで紐付け
+            with file.getbuffer() as file_bytes:
+                encoding = FileProcessor._detect_encoding_stage(file_bytes)
+
+            file.seek(0)
+            reader = pd.read_csv(
+                file,
+                encoding=encoding,
+                skiprows=FileProcessor.INVENTORY_PREAMBLE_ROWS,
+                usecols=FileProcessor.INVENTORY_COLUMNS,
+                dtype={
+                    '薬品名': STRING_DTYPE,
+                    '使用期限': str,
+                    'ロット番号': STRING_DTYPE
+                },
+                chunksize=chunksize or FileProcessor.INVENTORY_CHUNK_SIZE)
+            with reader:
+                for chunk in instrumentation.timed_iter('ingest.inventory',
+                                                        reader):
+                    chunk = FileProcessor._filter_drug_names(chunk)
+                    yield FileProcessor._filter_quantity(chunk)
+        except Exception as e:
+            raise Exception(f"CSVファイルの読み込みエラー: {str(e)}")
+
+    @staticmethod
+    def to_category(values):
+        # 同じ値が繰り返される文字列の列をカテゴリ型にする（空の値は空文字列）
+        # 結合後の欠損を空文字列で埋められるよう、カテゴリには常に空文字列を含め、
+        # 並べ替えの結果が文字列の場合と同じになるよう文字列の順に並べる
+        if isinstance(values.dtype, pd.CategoricalDtype) and (
+                '' in values.cat.categories):
+            return values
+        values = values.astype(object).where(values.notna(), '').astype(str)
+        categories = sorted(set(values.unique()) | {''})
+        return values.astype(pd.CategoricalDtype(categories))
+
+    @staticmethod
+    def normalize_drug_name(names):
+        # 薬品名の照合キー（全角/半角の正規化と前後の空白の除去）
+        return names.fillna('').astype(str).str.normalize('NFKC').str.strip()
+
+    @staticmethod
+    def build_yj_master(yj_code_df):
+        # 在庫金額CSVから 薬品名キー → ＹＪコード・単位・単価 の対応表を作成
+        # 単価は 在庫金額 / 在庫量（列がない場合や在庫量が0の場合は NaN）
+        with instrumentation.stage('process.yj_master',
+                                   rows_in=len(yj_code_df)) as metrics:
+            if {'在庫金額', '在庫量'} <= set(yj_code_df.columns):
+                quantity = pd.to_numeric(yj_code_df['在庫量'], errors='coerce')
+                unit_price = pd.to_numeric(yj_code_df['在庫金額'],
+                                           errors='coerce') / quantity.where(
+                                               quantity > 0)
+            else:
+                unit_price = np.nan
+            yj_master = pd.DataFrame({
+                '薬品名キー':
+                FileProcessor.normalize_drug_name(yj_code_df['薬品名']),
+                'ＹＪコード': yj_code_df['ＹＪコード'].fillna('').astype(str),
+                '単位': FileProcessor.to_category(yj_code_df['単位']),
+                '単価': unit_price,
+            })
+            # 同じ薬品名が複数ある場合は後の行を優先する
+            yj_master = yj_master.drop_duplicates('薬品名キー', keep='last')
+            metrics['rows_out'] = len(yj_master)
+        return yj_master
+
+    @staticmethod
+    def resolve_yj_codes(inventory_df, yj_master, name_matcher=None):
+        # 薬品名の種類ごとに一度だけ照合キーを作り、対応表と結合して
+        # ＹＪコードと単位を一度に設定する
+        # name_matcher（NameMatcher）を渡すと、完全一致しなかった薬品名を
+        # あいまい照合し、照合スコア列（完全一致は 1.0）も設定する
+        codes, names = pd.factorize(inventory_df['薬品名'].fillna(''))
+        keys = FileProcessor.normalize_drug_name(pd.Series(names))
+        master = yj_master.set_index('薬品名キー')
+        matched = master.reindex(keys)
+        columns = ['ＹＪコード', '単位']
+        if '単価' in master.columns:
+            columns.append('単価')
+        if name_matcher is not None:
+            matched['照合スコア'] = np.where(matched['ＹＪコード'].notna(), 1.0,
+                                        np.nan)
+            missing = matched['ＹＪコード'].isna().to_numpy()
+            if missing.any():
+                fuzzy = name_matcher.match(keys[missing])
+                found = fuzzy['薬品名キー'].notna().to_numpy()
+                rows = np.flatnonzero(missing)[found]
+                fuzzy_matched = master.reindex(fuzzy['薬品名キー'][found])
+                for col in columns:
+                    matched.iloc[rows, matched.columns.get_loc(col)] = (
+                        fuzzy_matched[col].to_numpy())
+                matched.iloc[rows, matched.columns.get_loc('照合スコア')] = (
+                    fuzzy['照合スコア'][found].to_numpy())
+            columns.append('照合スコア')
+        resolved = inventory_df.drop(columns=columns, errors='ignore')
+        # 対応表の列の型（単位のカテゴリ型など）のまま設定する
+        for col in columns:
+            resolved[col] = matched[col].array.take(codes)
+        return resolved
+
+    @staticmethod
+    def _guess_date_format(expiry):
+        # 使用期限の書式を最初の値から推定する（pd.to_datetime の推定と同じ）
+        values = expiry.dropna()
+        if values.empty or not isinstance(values.iloc[0], str):
+            return None
+        return guess_datetime_format(values.iloc[0])
+
+    @staticmethod
+    def _process_inventory_chunk(inventory_df, purchase_df, yj_master,
+                                 date_format=None, name_matcher=None,
+                                 feature_columns=()):
+        # 在庫データ（またはそのチャンク）を検証し、ＹＪコードを設定して
+        # 購入履歴と紐付ける。ＹＪコード設定済みの在庫データと、チャンク間で
+        # 同じ書式で使用期限を解釈するために推定した書式も返す
+        # feature_columns の列（優先度の採点用）と元の薬局の列は、
+        # 空文字列に変換せずに結果に含める
+        # データの前処理と検証
+        # 各検証では残す行を決めるだけにし、最後に必要な列の残す行だけを
+        # 一度に取り出す（在庫量は整数、使用期限は日付のまま持つ）
+        # 空の薬品名を持つ行を削除
+        with instrumentation.stage('process.drug_name_filter',
+                                   rows_in=len(inventory_df)) as metrics:
+            names = inventory_df['薬品名']
+            keep = (names.notna() & (names.str.strip() != '')).to_numpy(
+                dtype=bool, na_value=False)
+            metrics['rows_out'] = int(keep.sum())
+
+        # 在庫量のバリデーション
+        with instrumentation.stage('process.quantity_filter',
+                                   rows_in=int(keep.sum())) as metrics:
+            quantity = pd.to_numeric(inventory_df['在庫量'], errors='coerce')
+            keep &= (quantity > 0).to_numpy()
+            metrics['rows_out'] = int(keep.sum())
+
+        # 使用期限のフォーマットチェックと変換
+        with instrumentation.stage('process.expiry_parse',
+                                   rows_in=int(keep.sum())) as metrics:
+            expiry = inventory_df['使用期限']
+            if date_format is None:
+                date_format = FileProcessor._guess_date_format(expiry[keep])
+            expiry = pd.to_datetime(expiry, format=date_format, errors='coerce')
+            keep &= expiry.notna().to_numpy()
+            metrics.update(rows_out=int(keep.sum()), format=date_format)
+
+        rows = np.flatnonzero(keep)
+        quantity = quantity.iloc[rows]
+        if quantity.dtype.kind == 'f' and (quantity % 1 == 0).all():
+            quantity = quantity.astype(np.int64)
+        source_columns = [
+            col for col in [FileProcessor.SOURCE_COLUMN]
+            if col in inventory_df.columns
+        ]
+        inventory_df = pd.DataFrame({
+            '薬品名':
+            names.iloc[rows].astype(STRING_DTYPE, copy=False).array,
+            '在庫量': quantity.array,
+            '使用期限': expiry.iloc[rows].array,
+            'ロット番号':
+            inventory_df['ロット番号'].iloc[rows].fillna('').astype(
+                STRING_DTYPE, copy=False).array,
+            **{col: inventory_df[col].iloc[rows].array
+               for col in source_columns},
+        })
+
+        # 不良在庫データに対してＹＪコードと単位を設定
+        with instrumentation.stage('process.yj_mapping',
+                                   rows_in=len(inventory_df)) as metrics:
+            inventory_df = FileProcessor.resolve_yj_codes(
+                inventory_df, yj_master, name_matcher)
+            metrics['matched'] = int(inventory_df['ＹＪコード'].notna().sum())
+            if name_matcher is not None:
+                metrics['fuzzy_matched'] = int(
+                    (inventory_df['照合スコア'] < 1).sum())
+
+        # ＹＪコードと厚労省CDで紐付け
+        with instrumentation.stage('process.merge',
+                                   rows_in=len(inventory_df)) as metrics:
             merged_df = pd.merge(inventory_df,
-                                 purchase_history_df[[
-                                     '厚労省CD', '法人名', '院所名', '品名・規格', '新薬品ｺｰﾄﾞ'
-                                 ]],
+                                 purchase_df,
                                  left_on='ＹＪコード',
                                  right_on='厚労省CD',
                                  how='left')
-            print(f"マージ後のデータ行数: {len(merged_df)}")
+            metrics['rows_out'] = len(merged_df)
+
+        # 院所名別にデータを整理し、紐付かなかった名称・コードの空の値を
+        # 空文字列に変換（merge の結果は新しい DataFrame のため列ごとに置き換える）
+        for col in FileProcessor.PURCHASE_COLUMNS + ['単位']:
+            if merged_df[col].hasnans:
+                merged_df[col] = merged_df[col].fillna('')
+        result_df = merged_df[FileProcessor.RESULT_COLUMNS + source_columns +
+                              list(feature_columns)]
+        return (result_df,
+                inventory_df[FileProcessor.INVENTORY_COLUMNS +
+                             ['ＹＪコード', '単位'] + source_columns],
+                date_format)
+
+    @staticmethod
+    def build_purchase_index(purchase_history_df, max_clinics=None):
+        # 購入履歴を (厚労省CD, 法人名, 院所名) ごとに1行へ集約した索引を作る
+        # 購入回数に加え、列がある場合は最終購入日と購入数量合計を持つ
+        # 品名・規格と新薬品ｺｰﾄﾞは最も新しい購入のものを使う
+        # max_clinics を指定すると、薬品ごとに購入回数・最終購入日の順で
+        # 上位の院所だけを候補として残す
+        with instrumentation.stage(
+                'process.purchase_index',
+                rows_in=len(purchase_history_df)) as metrics:
+            # 名称・コードはカテゴリ型（read_purchase_history で変換済みの
+            # 場合はそのまま）で持ち、院所・薬品ごとの集約もカテゴリのまま行う
+            history = pd.DataFrame({
+                col: FileProcessor.to_category(purchase_history_df[col])
+                for col in FileProcessor.PURCHASE_COLUMNS
+            })
+            aggregations = {
+                '品名・規格': ('品名・規格', 'first'),
+                '新薬品ｺｰﾄﾞ': ('新薬品ｺｰﾄﾞ', 'first'),
+                '購入回数': ('院所名', 'size'),
+            }
+            rank_columns = ['購入回数']
+
+            date_column = FileProcessor.PURCHASE_DATE_COLUMN
+            if date_column in purchase_history_df.columns:
+                history['最終購入日'] = pd.to_datetime(
+                    purchase_history_df[date_column], errors='coerce')
+                history = history.sort_values('最終購入日',
+                                              ascending=False,
+                                              kind='stable')
+                aggregations['最終購入日'] = ('最終購入日', 'max')
+                rank_columns.append('最終購入日')
+
+            quantity_column = FileProcessor.PURCHASE_QUANTITY_COLUMN
+            if quantity_column in purchase_history_df.columns:
+                history['購入数量合計'] = pd.to_numeric(
+                    purchase_history_df[quantity_column], errors='coerce')
+                aggregations['購入数量合計'] = ('購入数量合計', 'sum')
+
+            purchase_index = history.groupby(
+                ['厚労省CD', '法人名', '院所名'], sort=False,
+                observed=True).agg(**aggregations)
+            purchase_index = purchase_index.reset_index()
+
+            if max_clinics is not None:
+                ranked = purchase_index.sort_values(rank_columns,
+                                                    ascending=False,
+                                                    kind='stable')
+                top = ranked.groupby('厚労省CD',
+                                     observed=True).cumcount() < max_clinics
+                purchase_index = ranked[top].sort_index()
+            metrics['rows_out'] = len(purchase_index)
+
+        return purchase_index
+
+    @staticmethod
+    def process_data(purchase_history_df,
+                     inventory_df,
+                     yj_code_df=None,
+                     yj_master=None,
+                     return_inventory=False,
+                     purchase_index=None,
+                     max_clinics_per_lot=None,
+                     name_matcher=None,
+                     prioritizer=None):
+        # 購入履歴は build_purchase_index で (厚労省CD, 法人名, 院所名) ごとに
+        # 集約してから紐付ける。作成済みの索引を purchase_index に渡せる
+        # max_clinics_per_lot を指定すると、在庫1行あたりの候補院所数を制限する
+        # yj_master には build_yj_master で作成済みの対応表を渡せる
+        # （在庫金額CSVのキャッシュを利用する場合）
+        # name_matcher に対応表の NameMatcher を渡すと、完全一致しなかった
+        # 薬品名をあいまい照合する
+        # prioritizer（Prioritizer）を渡すと、院所の中を優先度の高い順に並べ、
+        # 設定に応じて院所ごとの上位の行だけを残す
+        # inventory_df には DataFrame のほか、iter_inventory_chunks で
+        # 分割して読み込んだチャンクのイテレータを渡せる
+        # return_inventory=True の場合は、ＹＪコードを設定した在庫データ
+        # （データベース保存用）も合わせて返す
+        try:
+            if yj_master is None:
+                yj_master = FileProcessor.build_yj_master(yj_code_df)
 
-            # 院所名別にデータを整理
-            result_df = merged_df[[
-                '品名・規格', '在庫量', '単位', '新薬品ｺｰﾄﾞ', '使用期限', 'ロット番号', '法人名', '院所名'
-            ]].copy()
+            if purchase_index is None:
+                purchase_index = FileProcessor.build_purchase_index(
+                    purchase_history_df, max_clinics=max_clinics_per_lot)
 
-            # 空の値を空文字列に変換
-            result_df = result_df.fillna('')
+            purchase_columns = FileProcessor.PURCHASE_COLUMNS
+            feature_columns = []
+            if prioritizer is not None:
+                # 採点に使う購入回数・最終購入日・単価も紐付けて結果に残す
+                purchase_columns = purchase_columns + [
+                    col for col in prioritizer.FEATURE_COLUMNS
+                    if col in purchase_index.columns
+                ]
+                feature_columns = [
+                    col for col in prioritizer.FEATURE_COLUMNS
+                    if col in purchase_columns or col in yj_master.columns
+                ]
+            purchase_df = purchase_index[purchase_columns]
 
-            # データの検証
-            # 必須項目のチェック
-            required_columns = ['品名・規格', '在庫量', '使用期限']
-            for col in required_columns:
-                missing = result_df[result_df[col] == ''].shape[0]
-                print(f"{col}の欠損数: {missing}")
+            if isinstance(inventory_df, pd.DataFrame):
+                inventory_chunks = [inventory_df]
+            else:
+                inventory_chunks = inventory_df
 
-            # 院所名でソート
-            result_df = result_df.sort_values(['法人名', '院所名'])
-            print(f"最終データ行数: {len(result_df)}")
+            # チャンクごとに処理し、結果だけを保持する
+            results = []
+            inventories = []
+            date_format = None
+            inventory_rows = matched_rows = 0
+            for chunk in inventory_chunks:
+                chunk_result, chunk_inventory, date_format = (
+                    FileProcessor._process_inventory_chunk(
+                        chunk, purchase_df, yj_master, date_format,
+                        name_matcher, feature_columns))
+                results.append(chunk_result)
+                inventory_rows += len(chunk_inventory)
+                matched_rows += int(chunk_inventory['ＹＪコード'].notna().sum())
+                if return_inventory:
+                    inventories.append(chunk_inventory)
+            if results:
+                result_df = pd.concat(results, ignore_index=True)
+            else:
+                result_df = pd.DataFrame(columns=FileProcessor.RESULT_COLUMNS +
+                                         feature_columns)
 
+            if prioritizer is not None:
+                # 院所名でソートし、院所の中は優先度の高い順にする
+                result_df = prioritizer.rank(result_df)
+            else:
+                # 院所名でソート
+                result_df = result_df.sort_values(['法人名', '院所名'])
+
+            # マッピング率・紐付けによる行数の増加・必須項目の欠損数を記録
+            instrumentation.annotate(
+                purchase_index_rows=len(purchase_index),
+                yj_master_rows=len(yj_master),
+                inventory_rows=inventory_rows,
+                yj_hit_rate=round(matched_rows / inventory_rows, 4)
+                if inventory_rows else None,
+                merge_fan_out=round(len(result_df) / inventory_rows, 2)
+                if inventory_rows else None,
+                result_rows=len(result_df),
+                missing={
+                    col: FileProcessor._count_missing(result_df[col])
+                    for col in ['品名・規格', '在庫量', '使用期限']
+                })
+
+            if return_inventory:
+                if inventories:
+                    resolved_df = pd.concat(inventories, ignore_index=True)
+                else:
+                    resolved_df = pd.DataFrame(
+                        columns=FileProcessor.INVENTORY_COLUMNS +
+                        ['ＹＪコード', '単位'])
+                return result_df, resolved_df
             return result_df
 
         except Exception as e:
-            print(f"データ処理中にエラーが発生: {str(e)}")
+            logger.exception("データ処理中にエラーが発生")
             raise Exception(f"データ処理エラー: {str(e)}")
 
     @staticmethod
-    def generate_excel(df):
+    def _count_missing(values):
+        # 空の値の数（在庫量・使用期限は数値・日付で持つため欠損値だけを数える）
+        if (pd.api.types.is_numeric_dtype(values)
+                or pd.api.types.is_datetime64_any_dtype(values)):
+            return int(values.isna().sum())
+        return int((values.isna() | (values == '')).sum())
+
+    @staticmethod
+    def _clean_sheet_name(name):
+        # シート名として無効な文字を置換する
+        if not isinstance(name, str) or not name.strip():
+            return 'Unknown'
+        # 特殊文字を置換
+        invalid_chars = ['/', '\\', '?', '*', ':', '[', ']']
+        cleaned_name = ''.join('_' if c in invalid_chars else c
+                               for c in name)
+        # 最大31文字に制限（Excelの制限）
+        return cleaned_name[:31].strip()
+
+    @staticmethod
+    def generate_excel(df, streaming=False):
+        # streaming=True の場合は書き込み専用モードのエンジンで出力する
+        with instrumentation.stage(
+                'excel.render',
+                rows_in=len(df),
+                engine='streaming' if streaming else 'openpyxl') as metrics:
+            if streaming:
+                excel_buffer = FileProcessor._generate_excel_streaming(df)
+            else:
+                excel_buffer = FileProcessor._generate_excel_openpyxl(df)
+            metrics['bytes'] = excel_buffer.getbuffer().nbytes
+        return excel_buffer
+
+    @staticmethod
+    def _generate_excel_openpyxl(df):
         excel_buffer = io.BytesIO()
 
-        # シート名として無効な文字を置換する関数
-        def clean_sheet_name(name):
-            if not isinstance(name, str) or not name.strip():
-                return 'Unknown'
-            # 特殊文字を置換
-            invalid_chars = ['/', '\\', '?', '*', ':', '[', ']']
-            cleaned_name = ''.join('_' if c in invalid_chars else c
-                                   for c in name)
-            # 最大31文字に制限（Excelの制限）
-            return cleaned_name[:31].strip()
+        clean_sheet_name = FileProcessor._clean_sheet_name
 
         # ExcelWriterを使用して、院所名ごとにシートを作成
         with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -166,11 +715,11 @@ class FileProcessor:
 
             # 院所名ごとにシートを作成（空の値を除外）
 
-            for name in df['院所名'].unique():
+            # 院所ごとのデータは一度のグループ化で取り出す
+            for name, sheet_df in df.groupby('院所名', sort=False,
+                                             observed=True):
                 if pd.notna(name) and str(name).strip():  # 空の値をスキップ
                     sheet_name = clean_sheet_name(str(name))
-                    # 該当する院所のデータを抽出
-                    sheet_df = df[df['院所名'] == name].copy()
 
                     # シートを定義（sheet_dfが空でも定義されるように）
                     worksheet = writer.book.create_sheet(sheet_name)
@@ -186,9 +735,6 @@ class FileProcessor:
                         insho_name = str(insho_name).strip() if pd.notna(
                             insho_name) else ''
 
-                        print(f"houjin_name: {houjin_name}")
-                        print(f"insho_name: {insho_name}")
-
                         if houjin_name and insho_name:  # 両方とも有効な場合にのみフォーマットを実行
                             header_text = '{} {} 御中'.format(
                                 houjin_name, insho_name)
@@ -196,14 +742,18 @@ class FileProcessor:
                             header_text = ' 御中'  # 例：片方が無効な場合はデフォルトテキスト
 
                         if not sheet_df.empty:
-                            # 表示用のカラムから法人名と院所名を除外
-                            display_df = sheet_df.drop(['法人名', '院所名'], axis=1)
+                            # 表示用のカラム（法人名と院所名を除外し、「引取り可能数」列を追加）
+                            # の値を、セルに書き込む文字列にする
+                            display_columns = FileProcessor._display_columns(
+                                sheet_df)
+                            display_df = pd.DataFrame(
+                                dict(
+                                    zip(
+                                        display_columns,
+                                        FileProcessor._cell_values(
+                                            sheet_df, display_columns))))
 
                             if not display_df.empty:  # display_df が空でない場合にのみ、シートを作成する
-                                # 「引取り可能数」列を追加
-                                display_df.insert(
-                                    display_df.columns.get_loc('ロット番号') + 1,
-                                    '引取り可能数', '')
 
                                 # ヘッダー情報を作成
                                 header_data = [
@@ -226,13 +776,13 @@ class FileProcessor:
                                                     index=False)
                                 sheet_created = True  # シート作成フラグをTrueにする
                             else:
-                                print(
+                                logger.debug(
                                     f"display_dfが空なのでシート{sheet_name}は作成をスキップします"
                                 )
                                 # 空のデータフレームの場合、何もせず次のループへ
                                 continue
                         else:
-                            print(f"sheet_dfが空なのでシート{sheet_name}は作成をスキップします")
+                            logger.debug(f"sheet_dfが空なのでシート{sheet_name}は作成をスキップします")
                             continue
 
                     # シートを取得してフォーマットを設定
@@ -290,3 +840,288 @@ class FileProcessor:
                 del writer.book[dummy_sheet_name]
         excel_buffer.seek(0)
         return excel_buffer
+
+    @staticmethod
+    def _excel_cell_styles(worksheet):
+        # 院所別シートで使う書式をワークブックに一度だけ登録し、セルのひな形として返す
+        thin = Side(style='thin')
+        thin_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+
+        def default_font(**changes):
+            # 既定フォント（Calibri）を基に、サイズなどを変更したフォントを作る
+            font = copy(DEFAULT_FONT)
+            for key, value in changes.items():
+                setattr(font, key, value)
+            return font
+
+        font = default_font(size=14)
+
+        def template(**style):
+            cell = WriteOnlyCell(worksheet)
+            for key, value in style.items():
+                setattr(cell, key, value)
+            return cell
+
+        return {
+            'title': template(font=default_font(size=16)),
+            'header': template(font=default_font(size=14, bold=True)),
+            'text': template(font=font),
+            # pandas の to_excel が出力する列見出しの書式に合わせる
+            'column': template(font=Font(bold=True, size=14),
+                               border=thin_border,
+                               alignment=Alignment(horizontal='center',
+                                                   vertical='top')),
+            'data': template(font=font, border=thin_border),
+        }
+
+    @staticmethod
+    def _write_clinic_sheet(workbook, styles, sheet_name, sheet_df, columns):
+        # 1院所分のシートを書き込み専用モードで出力する
+        worksheet = workbook.create_sheet(sheet_name)
+
+        def cell(value, style):
+            new_cell = WriteOnlyCell(worksheet, value)
+            # 登録済みの書式を共有し、セルごとの書式の生成を避ける
+            new_cell._style = copy(styles[style]._style)
+            return new_cell
+
+        houjin_name = sheet_df['法人名'].iloc[0]
+        insho_name = sheet_df['院所名'].iloc[0]
+        houjin_name = str(houjin_name).strip() if pd.notna(houjin_name) else ''
+        insho_name = str(insho_name).strip() if pd.notna(insho_name) else ''
+        if houjin_name and insho_name:
+            header_text = '{} {} 御中'.format(houjin_name, insho_name)
+        else:
+            header_text = ' 御中'
+
+        # 列幅・印刷設定（既存の generate_excel と同じ）
+        worksheet.column_dimensions['A'].width = 35
+        for col in ['B', 'C', 'D', 'E', 'F', 'G']:
+            worksheet.column_dimensions[col].width = 17
+        worksheet.page_setup.orientation = 'landscape'
+        worksheet.print_title_rows = '1:7'
+        worksheet.page_setup.fitToPage = True
+        worksheet.page_setup.fitToHeight = 0
+        worksheet.page_setup.fitToWidth = 1
+
+        # 行の高さは行を書き込む前に設定しておく必要がある
+        total_rows = len(sheet_df) + 7
+        for row in range(1, total_rows + 1):
+            worksheet.row_dimensions[row].height = 30
+
+        padding = len(columns) - 1
+        header_rows = [(FileProcessor.EXCEL_TITLE, 'title'), ('', 'text'),
+                       (header_text, 'header'), ('', 'text'),
+                       (FileProcessor.EXCEL_MESSAGE, 'text'), ('', 'text')]
+        for value, style in header_rows:
+            worksheet.append([cell(value, style)] +
+                             [cell(None, 'text') for _ in range(padding)])
+
+        worksheet.append([cell(name, 'column') for name in columns])
+
+        for row in zip(*FileProcessor._cell_values(sheet_df, columns)):
+            worksheet.append([cell(value, 'data') for value in row])
+
+    @staticmethod
+    def _cell_values(df, columns):
+        # 列ごとに、セルに書き込む値のリストを返す
+        # 在庫量・使用期限は処理中は整数・日付で持ち、ここで文字列
+        # （114、2026-11-01 など）にする。空の値と結果にない列
+        # （引取り可能数）は空文字列
+        values = []
+        for col in columns:
+            if col not in df.columns:
+                values.append([''] * len(df))
+                continue
+            column = df[col]
+            present = column.notna()
+            if (pd.api.types.is_numeric_dtype(column)
+                    or pd.api.types.is_datetime64_any_dtype(column)):
+                column = column.astype(str)
+            values.append(column.astype(object).where(present, '').tolist())
+        return values
+
+    @staticmethod
+    def _display_columns(df):
+        # 表示用のカラム（法人名と院所名を除き、ロット番号の後に「引取り可能数」）
+        columns = [c for c in df.columns if c not in ('法人名', '院所名')]
+        columns.insert(columns.index('ロット番号') + 1, '引取り可能数')
+        return columns
+
+    @staticmethod
+    def _write_clinic_sheets(workbook, styles, df, columns):
+        # 院所名ごとにシートを作成し（空の値は除外）、作成したシート数を返す
+        sheet_count = 0
+        for name, sheet_df in df.groupby('院所名', sort=False, observed=True):
+            if pd.isna(name) or not str(name).strip():
+                continue
+            sheet_name = FileProcessor._clean_sheet_name(str(name))
+            FileProcessor._write_clinic_sheet(workbook, styles, sheet_name,
+                                              sheet_df, columns)
+            sheet_count += 1
+        return sheet_count
+
+    @staticmethod
+    def _generate_excel_streaming(df):
+        # generate_excel と同じレイアウトのワークブックを、結果を一度だけ
+        # グループ化し、共有の書式で行単位に書き出して作成する
+        excel_buffer = io.BytesIO()
+        workbook = Workbook(write_only=True)
+
+        # 既存の出力と同じく先頭にダミーシートを置く
+        dummy_sheet = workbook.create_sheet('dummy_sheet')
+        styles = FileProcessor._excel_cell_styles(dummy_sheet)
+
+        columns = FileProcessor._display_columns(df)
+        FileProcessor._write_clinic_sheets(workbook, styles, df, columns)
+
+        workbook.save(excel_buffer)
+        excel_buffer.seek(0)
+        return excel_buffer
+
+    @staticmethod
+    def _clean_file_name(name):
+        # ファイル名として無効な文字を置換する
+        if not isinstance(name, str) or not name.strip():
+            return 'Unknown'
+        return re.sub(r'[\\/:*?"<>|]', '_', name).strip()
+
+    @staticmethod
+    def _render_partition(partition_df):
+        # 1ファイル分（法人または院所）のワークブックを作成してバイト列で返す
+        # プロセスプールのワーカーで実行される。シートがない場合は None
+        workbook = Workbook(write_only=True)
+        # 書式の登録にだけ使うシート（個別ファイルにはダミーシートを残さない）
+        style_sheet = workbook.create_sheet('dummy_sheet')
+        styles = FileProcessor._excel_cell_styles(style_sheet)
+        workbook.remove(style_sheet)
+
+        columns = FileProcessor._display_columns(partition_df)
+        if not FileProcessor._write_clinic_sheets(workbook, styles,
+                                                  partition_df, columns):
+            return None
+
+        excel_buffer = io.BytesIO()
+        workbook.save(excel_buffer)
+        return excel_buffer.getvalue()
+
+    @staticmethod
+    def _partition_key(partition_by, name, partition_df):
+        # 法人・院所ごとのファイルのキャッシュキー（分割単位・名前・行の内容）
+        row_hashes = pd.util.hash_pandas_object(partition_df, index=False)
+        digest = hashlib.sha256(row_hashes.to_numpy().tobytes())
+        digest.update('\0'.join(map(str, partition_df.columns)).encode())
+        return ('partition_workbook', partition_by, name, digest.hexdigest())
+
+    @staticmethod
+    def _partition_fingerprints(df, partition_by):
+        # 法人・院所ごとの、シートに書き込む値の指紋（行の順序は問わない）
+        # 列の型（カテゴリ型・日付など）によらず、書き込む文字列で比べる
+        columns = list(df.columns)
+        cells = pd.DataFrame(dict(zip(columns,
+                                      FileProcessor._cell_values(df, columns))))
+        hashes = pd.DataFrame({
+            'name': cells[partition_by],
+            'hash': pd.util.hash_pandas_object(cells, index=False).to_numpy(),
+        }).sort_values(['name', 'hash'])
+        fingerprints = {}
+        for name, group in hashes.groupby('name', sort=False):
+            digest = hashlib.sha256(group['hash'].to_numpy().tobytes())
+            digest.update('\0'.join(columns).encode())
+            fingerprints[name] = digest.hexdigest()
+        return fingerprints
+
+    @staticmethod
+    def changed_partitions(df, previous_df, partition_by='院所名'):
+        # previous_df（前回の結果）と比べて、行の内容が変わった（または新しい）
+        # 法人名・院所名の一覧を返す。前回にしかないものは含めない
+        current = FileProcessor._partition_fingerprints(df, partition_by)
+        previous = FileProcessor._partition_fingerprints(previous_df,
+                                                         partition_by)
+        return [
+            name for name, fingerprint in current.items()
+            if previous.get(name) != fingerprint
+        ]
+
+    @staticmethod
+    def generate_excel_zip(df,
+                           partition_by='院所名',
+                           include_combined=False,
+                           max_workers=None,
+                           cache=None):
+        # 結果を法人名または院所名で分割し、ファイルごとのワークブックを
+        # プロセスプールで並列に作成して ZIP にまとめる
+        # include_combined=True の場合は全院所をまとめたワークブックも同梱する
+        # max_workers の既定値は環境変数 EXCEL_WORKERS（未設定時はCPU数）
+        # cache（PipelineCache など）を渡すと、内容が前回と同じ法人・院所の
+        # ファイルは作り直さずに再利用し、変わったものだけを作成する
+        if partition_by not in ('法人名', '院所名'):
+            raise ValueError(f"分割単位が不正です: {partition_by}")
+        if max_workers is None:
+            max_workers = int(os.environ.get('EXCEL_WORKERS', 0)) or os.cpu_count()
+
+        try:
+            partitions = [(str(name), partition_df) for name, partition_df in
+                          df.groupby(partition_by, sort=False,
+                                     observed=True)]
+            names = [name for name, _ in partitions]
+            frames = [partition_df for _, partition_df in partitions]
+
+            keys = [
+                FileProcessor._partition_key(partition_by, name, frame)
+                for name, frame in zip(names, frames)
+            ]
+            workbooks = [
+                None if cache is None else cache.get(key) for key in keys
+            ]
+            pending = [i for i, content in enumerate(workbooks)
+                       if content is None]
+
+            workers = min(max_workers, len(pending))
+            with instrumentation.stage('excel.render_partitions',
+                                       rows_in=len(df),
+                                       partitions=len(frames),
+                                       rendered=len(pending),
+                                       workers=workers):
+                pending_frames = [frames[i] for i in pending]
+                if workers > 1:
+                    rendered = list(
+                        get_process_pool(max_workers).map(
+                            FileProcessor._render_partition, pending_frames))
+                else:
+                    rendered = [
+                        FileProcessor._render_partition(f)
+                        for f in pending_frames
+                    ]
+            for i, content in zip(pending, rendered):
+                # シートがないファイルは空のバイト列として扱う
+                workbooks[i] = content or b''
+                if cache is not None:
+                    cache.put(keys[i], workbooks[i])
+
+            zip_buffer = io.BytesIO()
+            used_names = set()
+            # xlsx は圧縮済みのため、ZIP では再圧縮しない
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for name, content in zip(names, workbooks):
+                    if not content:
+                        continue
+                    file_name = FileProcessor._clean_file_name(name)
+                    # 置換後に同じ名前になった場合は連番を付ける
+                    unique_name, suffix = file_name, 1
+                    while unique_name in used_names:
+                        suffix += 1
+                        unique_name = f"{file_name}_{suffix}"
+                    used_names.add(unique_name)
+                    archive.writestr(f"{unique_name}.xlsx", content)
+
+                if include_combined:
+                    combined = FileProcessor._generate_excel_streaming(df)
+                    archive.writestr('不良在庫_全院所.xlsx', combined.getvalue())
+
+            zip_buffer.seek(0)
+            return zip_buffer
+
+        except Exception as e:
+            logger.exception("ZIP出力中にエラーが発生")
+            raise Exception(f"ZIP出力エラー: {str(e)}")
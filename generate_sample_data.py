@@ -1,31 +1,227 @@
-import pandas as pd
+import argparse
+import io
+import os
+from datetime import datetime
+
 import numpy as np
-from datetime import datetime, timedelta
-
-# YJコードマスターの作成
-yj_codes = pd.DataFrame({
-    '商品コード': ['P' + str(i).zfill(5) for i in range(1, 11)],
-    'YJコード': ['YJ' + str(i).zfill(8) for i in range(1, 11)],
-    '商品名': [f'医薬品{i}' for i in range(1, 11)]
-})
-yj_codes.to_csv('sample_yj_codes.csv', index=False, encoding='utf-8-sig')
-
-# 購入履歴データの作成
-purchase_history = pd.DataFrame({
-    '商品コード': np.random.choice(yj_codes['商品コード'], size=20),
-    '購入日': [datetime.now() - timedelta(days=x) for x in range(20)],
-    '購入数量': np.random.randint(1, 10, size=20)
-})
-purchase_history.to_excel('sample_purchase_history.xlsx', index=False)
-
-# 不良在庫データの作成
-inventory = pd.DataFrame({
-    'YJコード': np.random.choice(yj_codes['YJコード'], size=15),
-    '商品名': [f'医薬品{i}' for i in range(1, 16)],
-    '在庫数量': np.random.randint(1, 20, size=15),
-    '有効期限': [(datetime.now() + timedelta(days=x*30)).strftime('%Y-%m-%d') for x in range(1, 16)],
-    '薬局ID': ['PH' + str(i).zfill(3) for i in range(1, 16)]
-})
-inventory.to_csv('sample_inventory.csv', index=False, encoding='utf-8-sig')
-
-print("サンプルデータの生成が完了しました。")
+import pandas as pd
+from openpyxl import Workbook
+
+# 薬品名の組み立てに使う成分名・剤形・規格・メーカー
+INGREDIENTS = [
+    'アムロジピン', 'ロスバスタチン', 'ファモチジン', 'ランソプラゾール', 'メトホルミン',
+    'カンデサルタン', 'オルメサルタン', 'ビソプロロール', 'エチゾラム', 'ロキソプロフェン',
+    'セレコキシブ', 'レバミピド', 'モンテルカスト', 'フェキソフェナジン', 'クラリスロマイシン',
+    'レボフロキサシン', 'アトルバスタチン', 'シタグリプチン', 'テルミサルタン', 'ゾルピデム',
+    'プレガバリン', 'ドネペジル', 'タムスロシン', 'エソメプラゾール', 'バルサルタン'
+]
+FORMS = ['錠', 'OD錠', 'カプセル', '細粒', '散', '内用液', 'テープ']
+STRENGTHS = ['0.5mg', '1mg', '2.5mg', '5mg', '10mg', '20mg', '40mg', '100mg']
+MAKERS = ['「サワイ」', '「トーワ」', '「日医工」', '「明治」', '「NP」', '「DSEP」', '']
+UNITS = {
+    '錠': '錠',
+    'OD錠': '錠',
+    'カプセル': 'カプセル',
+    '細粒': 'g',
+    '散': 'g',
+    '内用液': 'mL',
+    'テープ': '枚'
+}
+AREAS = ['中央', '北', '南', '東', '西', '駅前', '本町', '緑ヶ丘', '桜台', '港']
+
+# 不良在庫CSVの先頭7行（実際の出力に合わせた前置き）
+INVENTORY_PREAMBLE = [
+    '不良在庫一覧表,,,,,',
+    '出力日時,{date},,,,',
+    '薬局名,サンプル薬局,,,,',
+    '抽出条件,最終出庫日から180日以上,,,,',
+    ',,,,,',
+    '※ 金額は税抜,,,,,',
+    ',,,,,',
+]
+
+# OMEC他院所ファイルの列（読み込まない列も実際のファイルと同じく含める）
+PURCHASE_XLSX_COLUMNS = [
+    '法人名', '院所名', '厚労省CD', '新薬品ｺｰﾄﾞ', '品名・規格', '規格単位', '購入日', '数量', '薬価'
+]
+
+
+def make_master(rows, rng):
+    # 在庫金額CSV（薬品名・ＹＪコード・単位・在庫量・在庫金額）
+    index = np.arange(rows)
+    ingredient = np.array(INGREDIENTS)[index % len(INGREDIENTS)]
+    form_index = (index // len(INGREDIENTS)) % len(FORMS)
+    form = np.array(FORMS)[form_index]
+    strength = np.array(STRENGTHS)[(index // (len(INGREDIENTS) * len(FORMS))) %
+                                   len(STRENGTHS)]
+    maker = np.array(MAKERS)[(index // (len(INGREDIENTS) * len(FORMS) *
+                                        len(STRENGTHS))) % len(MAKERS)]
+    # 組み合わせが尽きた後も薬品名が重複しないよう通し番号を付ける
+    serial = np.where(
+        index < len(INGREDIENTS) * len(FORMS) * len(STRENGTHS) * len(MAKERS),
+        '', (index // 100).astype(str))
+    names = pd.Series(ingredient).str.cat(
+        [pd.Series(serial), pd.Series(form), pd.Series(strength), pd.Series(maker)])
+    # ＹＪコード（12桁: 薬効分類4桁 + 3桁 + 剤形1文字 + 4桁）
+    yj_codes = [
+        f'{1100 + i // 1000 % 8900:04d}{i % 1000:03d}F{i * 7 % 10}{i * 13 % 1000:03d}'
+        for i in range(rows)
+    ]
+    quantity = rng.integers(1, 500, rows)
+    unit_price = rng.gamma(1.5, 60, rows).round(1) + 5.0
+    return pd.DataFrame({
+        '薬品名': names,
+        'ＹＪコード': yj_codes,
+        '単位': pd.Series(form).map(UNITS),
+        '在庫量': quantity,
+        '在庫金額': (quantity * unit_price).round().astype(int),
+    })
+
+
+def make_inventory(master, rows, rng, dirty_fraction=0.02):
+    # 不良在庫データ（薬品名・在庫量・使用期限・ロット番号）
+    # dirty_fraction の割合で、空の薬品名・0以下の在庫量・不正な使用期限・
+    # 全角/半角の表記ゆれを混ぜる
+    pick = rng.integers(0, len(master), rows)
+    names = master['薬品名'].to_numpy()[pick].astype(object)
+    quantity = rng.integers(1, 300, rows)
+    today = datetime.now().date()
+    expiry = pd.to_datetime(today) + pd.to_timedelta(
+        rng.integers(-60, 1100, rows), unit='D')
+    expiry = expiry.strftime('%Y/%m/%d').to_numpy().astype(object)
+    lots = np.char.add('L', rng.integers(100000, 999999, rows).astype(str))
+    lots = lots.astype(object)
+
+    dirty = rng.random(rows) < dirty_fraction
+    kind = rng.integers(0, 4, rows)
+    names[dirty & (kind == 0)] = ''
+    quantity[dirty & (kind == 1)] = 0
+    expiry[dirty & (kind == 2)] = '不明'
+    # 全角の英数字（ｍｇ など）の表記ゆれ
+    variants = dirty & (kind == 3)
+    names[variants] = [
+        name.translate(str.maketrans('mgOD', 'ｍｇＯＤ')) for name in names[variants]
+    ]
+    return pd.DataFrame({
+        '薬品名': names,
+        '在庫量': quantity,
+        '使用期限': expiry,
+        'ロット番号': lots,
+    })
+
+
+def make_purchase_history(master, rows, clinics, rng, drugs_per_clinic=0.05):
+    # OMEC他院所の購入履歴。院所ごとに購入する薬品（マスターの drugs_per_clinic の割合）
+    # を決め、その中から購入行を作る
+    corporations = max(1, clinics // 5)
+    clinic_names = np.array([
+        f'{AREAS[i % len(AREAS)]}クリニック{i}' for i in range(clinics)
+    ])
+    corporation_names = np.array(
+        [f'医療法人{AREAS[i % len(AREAS)]}会{i}' for i in range(corporations)])
+    clinic_corporation = corporation_names[np.arange(clinics) % corporations]
+
+    clinic = rng.integers(0, clinics, rows)
+    per_clinic = max(1, int(len(master) * drugs_per_clinic))
+    # 院所ごとの購入薬品の範囲をずらして、薬品ごとの購入院所数を散らす
+    offset = (clinic * 7919) % len(master)
+    drug = (offset + rng.integers(0, per_clinic, rows)) % len(master)
+
+    purchased_at = pd.to_datetime(datetime.now().date()) - pd.to_timedelta(
+        rng.integers(0, 730, rows), unit='D')
+    unit_price = rng.gamma(1.5, 60, len(master)).round(1) + 5.0
+    return pd.DataFrame({
+        '法人名': clinic_corporation[clinic],
+        '院所名': clinic_names[clinic],
+        '厚労省CD': master['ＹＪコード'].to_numpy()[drug],
+        '新薬品ｺｰﾄﾞ': (100000 + drug).astype(str),
+        '品名・規格': master['薬品名'].to_numpy()[drug],
+        '規格単位': master['単位'].to_numpy()[drug],
+        '購入日': purchased_at,
+        '数量': rng.integers(1, 50, rows),
+        '薬価': unit_price[drug],
+    })[PURCHASE_XLSX_COLUMNS]
+
+
+def inventory_csv_bytes(inventory, encoding='cp932'):
+    # 7行の前置きを付けた不良在庫CSV
+    preamble = '\n'.join(INVENTORY_PREAMBLE).format(
+        date=datetime.now().strftime('%Y/%m/%d %H:%M')) + '\n'
+    return (preamble + inventory.to_csv(index=False)).encode(encoding)
+
+
+def master_csv_bytes(master, encoding='cp932'):
+    return master.to_csv(index=False).encode(encoding)
+
+
+def purchase_xlsx_bytes(purchase_history):
+    # 大きなファイルでも速く書けるよう、書き込み専用モードで行単位に出力する
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('他院所')
+    worksheet.append(list(purchase_history.columns))
+    for row in purchase_history.itertuples(index=False, name=None):
+        worksheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def generate(inventory_rows=1000,
+             purchase_rows=None,
+             master_rows=5000,
+             clinics=10,
+             seed=0,
+             dirty_fraction=0.02):
+    # 3つの入力ファイルをバイト列で返す
+    # purchase_rows の既定値は inventory_rows の2倍（上限 1,000,000 行）
+    rng = np.random.default_rng(seed)
+    if purchase_rows is None:
+        purchase_rows = min(inventory_rows * 2, 1_000_000)
+    master = make_master(master_rows, rng)
+    inventory = make_inventory(master, inventory_rows, rng, dirty_fraction)
+    purchase_history = make_purchase_history(master, purchase_rows, clinics, rng)
+    return {
+        'purchase': purchase_xlsx_bytes(purchase_history),
+        'inventory': inventory_csv_bytes(inventory),
+        'master': master_csv_bytes(master),
+    }
+
+
+# generate() の戻り値のキー → 出力ファイル名
+FILE_NAMES = {
+    'purchase': 'OMEC他院所.xlsx',
+    'inventory': '不良在庫.csv',
+    'master': '在庫金額.csv',
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='不良在庫CSV・在庫金額CSV・OMEC他院所XLSX のサンプルデータを作成する')
+    parser.add_argument('--inventory-rows', type=int, default=1000,
+                        help='不良在庫の行数（1,000〜1,000,000）')
+    parser.add_argument('--purchase-rows', type=int, default=None,
+                        help='購入履歴の行数（既定は不良在庫の2倍）')
+    parser.add_argument('--master-rows', type=int, default=5000,
+                        help='在庫金額マスターの薬品数')
+    parser.add_argument('--clinics', type=int, default=10,
+                        help='院所数（10〜1,000）')
+    parser.add_argument('--dirty-fraction', type=float, default=0.02,
+                        help='不正な値・表記ゆれを混ぜる割合')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out-dir', default='sample_data')
+    args = parser.parse_args()
+
+    files = generate(inventory_rows=args.inventory_rows,
+                     purchase_rows=args.purchase_rows,
+                     master_rows=args.master_rows,
+                     clinics=args.clinics,
+                     seed=args.seed,
+                     dirty_fraction=args.dirty_fraction)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for key, content in files.items():
+        path = os.path.join(args.out_dir, FILE_NAMES[key])
+        with open(path, 'wb') as f:
+            f.write(content)
+        print(f"{path}: {len(content):,} バイト")
+
+    print("サンプルデータの生成が完了しました。")
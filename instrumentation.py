@@ -0,0 +1,270 @@
+import contextvars
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows では使えない
+    resource = None
+
+logger = logging.getLogger('pipeline')
+
+# 実行中の処理のレポート（スレッド・ジョブごとに別）
+_current_run = contextvars.ContextVar('pipeline_run', default=None)
+_DONE = object()
+
+# プロセスの起動時の計測（このモジュールの読み込みからの経過秒数）
+_started = time.perf_counter()
+_startup = {'imports': {}, 'events': {}}
+
+
+def _rss_peak_mb():
+    # プロセスの最大RSS（MB）。Linux の ru_maxrss はKB単位
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class RunReport:
+    # 1回の処理（ジョブ・ベンチマークなど）の工程ごとの所要時間・行数・メモリ
+    # 同じ工程が複数回実行された場合（チャンクごとの処理など）は合算する
+
+    def __init__(self, name, trace_memory=False, **attributes):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attributes = attributes
+        self.trace_memory = trace_memory
+        self.started_at = datetime.now()
+        self.seconds = None
+        self.error = None
+        # 工程名 → 集計値（最初に実行された順）
+        self.stages = {}
+        self.summary = {}
+        self._memory_stack = []
+
+    def add_stage(self, name, seconds, metrics, mem_peak_mb, rss_peak_mb):
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        # 整数（行数など）は合算し、それ以外は最後の値を残す
+        for key, value in metrics.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                stage[key] = stage.get(key, 0) + value
+            else:
+                stage[key] = value
+        if mem_peak_mb is not None:
+            stage['mem_peak_mb'] = max(stage.get('mem_peak_mb', 0),
+                                       mem_peak_mb)
+        if rss_peak_mb is not None:
+            stage['rss_peak_mb'] = rss_peak_mb
+
+    def _enter_memory(self):
+        # 外側の工程のピークを退避してから、この工程用に計測をリセットする
+        peak = tracemalloc.get_traced_memory()[1]
+        if self._memory_stack:
+            self._memory_stack[-1] = max(self._memory_stack[-1], peak)
+        self._memory_stack.append(0)
+        tracemalloc.reset_peak()
+
+    def _exit_memory(self):
+        peak = max(self._memory_stack.pop(), tracemalloc.get_traced_memory()[1])
+        if self._memory_stack:
+            self._memory_stack[-1] = max(self._memory_stack[-1], peak)
+        tracemalloc.reset_peak()
+        return round(peak / 1024 / 1024, 1)
+
+    def to_dict(self):
+        return {
+            'run_id': self.run_id,
+            'name': self.name,
+            'attributes': self.attributes,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'seconds': self.seconds,
+            'error': self.error,
+            'rss_peak_mb': _rss_peak_mb(),
+            'stages': [{
+                'stage': name,
+                **stage, 'seconds': round(stage['seconds'], 4)
+            } for name, stage in self.stages.items()],
+            'summary': self.summary,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, default=str)
+
+    def write(self, directory):
+        # レポートを directory/run-<run_id>.json に保存してパスを返す
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'run-{self.run_id}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+        return path
+
+
+def current_run():
+    return _current_run.get()
+
+
+@contextmanager
+def run(name, trace_memory=None, **attributes):
+    # 処理全体を1つのレポートとして記録する。内側の stage() はこのレポートに集計される
+    # trace_memory=True（または環境変数 PIPELINE_TRACE_MEMORY=1）の場合は
+    # tracemalloc で工程ごとのピークメモリも計測する（処理は遅くなる。
+    # tracemalloc はプロセス全体で共有のため、並行して動く処理の分も含まれる）
+    # 環境変数 PIPELINE_REPORT_DIR を設定すると、終了時にレポートをJSONで保存する
+    if trace_memory is None:
+        trace_memory = os.environ.get('PIPELINE_TRACE_MEMORY') == '1'
+    report = RunReport(name, trace_memory=trace_memory, **attributes)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    token = _current_run.set(report)
+    start = time.perf_counter()
+    try:
+        yield report
+    except Exception as e:
+        report.error = str(e)
+        raise
+    finally:
+        report.seconds = round(time.perf_counter() - start, 4)
+        _current_run.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+        logger.info(name, extra={'event': 'run', 'report': report.to_dict()})
+        report_dir = os.environ.get('PIPELINE_REPORT_DIR')
+        if report_dir:
+            report.write(report_dir)
+
+
+@contextmanager
+def stage(name, **metrics):
+    # 工程の所要時間・メモリを計測し、yield した dict に行数などを追加できる
+    #   with instrumentation.stage('process.merge', rows_in=len(df)) as metrics:
+    #       merged = ...
+    #       metrics['rows_out'] = len(merged)
+    report = _current_run.get()
+    tracing = (report is not None and report.trace_memory and
+               tracemalloc.is_tracing())
+    if tracing:
+        report._enter_memory()
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        seconds = time.perf_counter() - start
+        mem_peak_mb = report._exit_memory() if tracing else None
+        rss_peak_mb = _rss_peak_mb()
+        if report is not None:
+            report.add_stage(name, seconds, metrics, mem_peak_mb, rss_peak_mb)
+        logger.info(name,
+                    extra={
+                        'event': 'stage',
+                        'run_id': report.run_id if report else None,
+                        'seconds': round(seconds, 4),
+                        'mem_peak_mb': mem_peak_mb,
+                        'rss_peak_mb': rss_peak_mb,
+                        'metrics': metrics,
+                    })
+
+
+def timed_iter(name, iterable):
+    # イテレータの各要素の取得を工程として記録する（チャンク読み込み用）
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as metrics:
+            item = next(iterator, _DONE)
+            if item is not _DONE:
+                metrics['rows_out'] = len(item)
+        if item is _DONE:
+            return
+        yield item
+
+
+def annotate(**values):
+    # 工程に属さない集計値（マッピング率など）をレポートに追加する
+    report = _current_run.get()
+    if report is not None:
+        report.summary.update(values)
+    logger.info('annotate',
+                extra={
+                    'event': 'annotate',
+                    'run_id': report.run_id if report else None,
+                    'values': values,
+                })
+
+
+def import_module(name):
+    # モジュールを読み込んで返す。初めて読み込む場合は所要時間を起動時の計測に記録する
+    # （重いモジュールを使う時まで読み込まないようにするため）
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    seconds = round(time.perf_counter() - start, 4)
+    _startup['imports'][name] = seconds
+    # module は LogRecord の属性名のため extra には使えない
+    logger.info('import', extra={
+        'event': 'startup',
+        'module_name': name,
+        'seconds': seconds
+    })
+    return module
+
+
+def mark_startup(event):
+    # 起動からの経過秒数を記録する（最初の描画・DBの準備完了など。各イベント1回だけ）
+    if event in _startup['events']:
+        return
+    seconds = round(time.perf_counter() - _started, 4)
+    _startup['events'][event] = seconds
+    logger.info(event, extra={'event': 'startup', 'seconds': seconds})
+
+
+def startup_report():
+    return {
+        'imports': dict(_startup['imports']),
+        'events': dict(_startup['events']),
+        'rss_peak_mb': _rss_peak_mb(),
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    # ログを1行1件のJSONで出力する。extra で渡した項目も含める
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+        'message', 'asctime'
+    }
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({
+            key: value
+            for key, value in vars(record).items() if key not in self.RESERVED
+        })
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level=None):
+    # ルートロガーにJSON形式の出力を設定する（設定済みの場合は何もしない）
+    # レベルの既定値は環境変数 LOG_LEVEL（未設定時は INFO）
+    root = logging.getLogger()
+    if any(isinstance(h.formatter, JsonFormatter) for h in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(level or os.environ.get('LOG_LEVEL', 'INFO'))
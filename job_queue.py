@@ -0,0 +1,259 @@
+import io
+import logging
+import os
+import threading
+
+import instrumentation
+from database import Database
+from file_processor import FileProcessor
+from master_cache import YJMasterCache
+from name_matcher import NameMatcher
+from prioritizer import Prioritizer
+from snapshot_store import SnapshotStore
+
+# 処理が終わっていないジョブの状態
+PENDING_STATUSES = ('queued', 'running')
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    # アップロードの処理（読み込み → process_data → 保存 → generate_excel）を
+    # バックグラウンドのワーカースレッドで実行する。ジョブ・入力ファイル・
+    # 結果のExcelはデータベースに保存し、画面側は状態を問い合わせて結果を取得する
+    # 同時に実行するジョブ数は環境変数 JOB_WORKERS で設定する
+    # 在庫金額CSVと完全一致しない薬品名のあいまい照合は、環境変数
+    # FUZZY_NAME_MATCH=0 で無効にできる
+    # 結果は院所の中で優先度の高い順に並べる。環境変数 PRIORITY_TOP_N を
+    # 設定すると、院所ごとに上位の件数だけをExcelに出力する
+    # 差分モードのジョブのExcelには、前回の差分保存から内容が変わった院所の
+    # シートだけを出力する（全院所の結果は画面・ZIP・スナップショットで得られる）
+    # 実行中のジョブは JOB_HEARTBEAT_INTERVAL 秒ごとに生存を記録し、記録が
+    # JOB_STALE_SECONDS 秒途絶えたジョブ（停止したプロセスのもの）は別のワーカーが
+    # 取り出し直す。取り出し直されたジョブの結果は保存しない
+
+    def __init__(self, workers=None, poll_interval=None, stale_seconds=None,
+                 cache=None, fuzzy_match=None, prioritizer=None,
+                 heartbeat_interval=None):
+        if workers is None:
+            workers = int(os.environ.get('JOB_WORKERS', 2))
+        if poll_interval is None:
+            poll_interval = float(os.environ.get('JOB_POLL_INTERVAL', 5))
+        if stale_seconds is None:
+            stale_seconds = float(os.environ.get('JOB_STALE_SECONDS', 300))
+        if heartbeat_interval is None:
+            heartbeat_interval = float(
+                os.environ.get('JOB_HEARTBEAT_INTERVAL', 30))
+        if fuzzy_match is None:
+            fuzzy_match = os.environ.get('FUZZY_NAME_MATCH', '1') != '0'
+        if prioritizer is None:
+            top_n = os.environ.get('PRIORITY_TOP_N')
+            prioritizer = Prioritizer(top_n=int(top_n) if top_n else None)
+        self.db = Database()
+        # 処理結果をバッチごとに保存するスナップショット（pyarrow がある場合）
+        self.snapshots = SnapshotStore()
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.fuzzy_match = fuzzy_match
+        self.prioritizer = prioritizer
+        # 処理結果（表示用の DataFrame を含む）を保持する PipelineCache
+        self.cache = cache
+        # 登録されたジョブの数だけワーカーを起こす
+        self._pending = threading.Semaphore(0)
+        self._threads = [
+            threading.Thread(target=self._work,
+                             name=f'job-worker-{i}',
+                             daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @staticmethod
+    def upload_key(purchase_file, inventory_file, yj_code_file):
+        # 3ファイルの内容ハッシュから、アップロードを識別するキーを作る
+        return ':'.join(
+            FileProcessor.content_hash(f)
+            for f in (purchase_file, inventory_file, yj_code_file))
+
+    def submit(self, pharmacy_id, purchase_file, inventory_file, yj_code_file,
+               upload_key=None, delta=False):
+        # ジョブを登録してIDを返す（同じアップロードの処理済みジョブがあればそのID）
+        # delta=True の場合は在庫を差分モードで保存する
+        if upload_key is None:
+            upload_key = self.upload_key(purchase_file, inventory_file,
+                                         yj_code_file)
+        files = {
+            role: (getattr(f, 'name', role), f.getvalue())
+            for role, f in [('purchase', purchase_file),
+                            ('inventory', inventory_file),
+                            ('yj_code', yj_code_file)]
+        }
+        job_id = self.db.create_job(pharmacy_id,
+                                    upload_key,
+                                    files,
+                                    delta=delta)
+        self._pending.release()
+        return job_id
+
+    def status(self, job_id):
+        return self.db.get_job(job_id)
+
+    def result(self, job_id):
+        return self.db.get_job_result(job_id)
+
+    def _work(self):
+        while True:
+            # 新しいジョブの登録か、poll_interval 秒の経過を待つ
+            self._pending.acquire(timeout=self.poll_interval)
+            try:
+                while self._run_next():
+                    pass
+            except Exception:
+                logger.exception("ジョブの取得中にエラーが発生")
+
+    def _run_next(self):
+        # 待機中のジョブを1件実行する。ジョブがなければ False を返す
+        job = self.db.claim_job(self.stale_seconds)
+        if job is None:
+            return False
+
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=self._heartbeat,
+                         args=(job, stop_heartbeat),
+                         name=f"job-heartbeat-{job['id']}",
+                         daemon=True).start()
+        # 工程ごとの所要時間・行数・メモリ（実行レポート）を timings に保存する
+        report = None
+        try:
+            with instrumentation.run('upload_job',
+                                     job_id=job['id'],
+                                     pharmacy_id=job['pharmacy_id']) as report:
+                files = {
+                    role: io.BytesIO(content)
+                    for role, (_, content) in self.db.get_job_files(
+                        job['id']).items()
+                }
+                result = self._process(files)
+                excel_df = result['result_df']
+                # 処理中に取り出し直された場合は、在庫を二重に保存しない
+                if not self.db.heartbeat_job(job['id'], job['claim_token']):
+                    raise Exception(
+                        f"ジョブ{job['id']}は別のワーカーが実行しています")
+                if job['delta']:
+                    # 前回からの追加・変更・削除だけを保存する
+                    delta = self.db.save_inventory_delta(
+                        result['inventory_df'],
+                        pharmacy_id=job['pharmacy_id'],
+                        upload_key=job['upload_key'])
+                    batch_id = delta['batch_id']
+                    # Excelには前回の差分保存から内容が変わった院所のシートだけを出力する
+                    previous_df = self._previous_delta_result(
+                        job['pharmacy_id'], batch_id)
+                    if previous_df is not None:
+                        clinics = FileProcessor.changed_partitions(
+                            excel_df, previous_df)
+                        excel_df = excel_df[excel_df['院所名'].isin(clinics)]
+                        delta['changed_clinics'] = len(clinics)
+                    instrumentation.annotate(delta=delta)
+                else:
+                    batch_id = self.db.save_inventory(
+                        result['inventory_df'],
+                        pharmacy_id=job['pharmacy_id'],
+                        upload_key=job['upload_key'])
+                # 書き込み専用モードで出力する（結果が空の場合もワークブックを作れる）
+                result['excel'] = FileProcessor.generate_excel(
+                    excel_df, streaming=True).getvalue()
+                # スナップショットの保存に失敗してもジョブは失敗にしない
+                try:
+                    self.snapshots.save(batch_id,
+                                        result['result_df'],
+                                        pharmacy_id=job['pharmacy_id'],
+                                        upload_key=job['upload_key'])
+                except Exception:
+                    logger.exception(f"バッチ{batch_id}のスナップショットの保存に失敗")
+            if not self.db.finish_job(job['id'], job['claim_token'],
+                                      result['excel'], report.to_dict(),
+                                      batch_id):
+                logger.warning(
+                    f"ジョブ{job['id']}は別のワーカーが実行しているため結果を保存しない")
+            if self.cache is not None:
+                # 差分モードのExcelは一部の院所だけのため、保存方法ごとに保持する
+                self.cache.put(('result', job['upload_key'], job['delta']),
+                               result)
+        except Exception as e:
+            logger.exception(f"ジョブ{job['id']}の処理中にエラーが発生")
+            self.db.fail_job(job['id'], job['claim_token'], str(e),
+                             report.to_dict() if report else None)
+        finally:
+            stop_heartbeat.set()
+        return True
+
+    def _heartbeat(self, job, stop):
+        # ジョブの実行中、heartbeat_interval 秒ごとに生存を記録する
+        # （取り出し直された場合は記録をやめる）
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                if not self.db.heartbeat_job(job['id'], job['claim_token']):
+                    return
+            except Exception:
+                logger.exception(f"ジョブ{job['id']}の生存の記録に失敗")
+
+    def _process(self, files):
+        cache = self.cache
+
+        def cached(key, compute):
+            if cache is None:
+                return compute()
+            return cache.get_or_compute(key, compute)
+
+        with instrumentation.stage('job.read'):
+            # 購入履歴は院所・薬品ごとに集約した索引として保持する
+            purchase_index = cached(
+                ('purchase_index', FileProcessor.content_hash(files['purchase'])),
+                lambda: FileProcessor.build_purchase_index(
+                    FileProcessor.read_purchase_history(
+                        files['purchase'],
+                        optional_columns=[
+                            FileProcessor.PURCHASE_DATE_COLUMN,
+                            FileProcessor.PURCHASE_QUANTITY_COLUMN,
+                        ],
+                        dedupe=False,
+                        cache_dir=os.environ.get('PURCHASE_CACHE_DIR'))))
+            # 在庫金額CSVは内容が同じなら保存済みの対応表を再利用する
+            yj_hash = FileProcessor.content_hash(files['yj_code'])
+            yj_master = cached(
+                ('yj_master', yj_hash),
+                lambda: YJMasterCache(self.db).load(files['yj_code']))
+            # あいまい照合の索引も対応表ごとに一度だけ作る
+            name_matcher = None
+            if self.fuzzy_match:
+                name_matcher = cached(('name_matcher', yj_hash),
+                                      lambda: NameMatcher(yj_master))
+
+        with instrumentation.stage('job.process'):
+            # 不良在庫CSVは分割して読み込み、チャンクごとに処理する
+            result_df, inventory_df = FileProcessor.process_data(
+                None,
+                FileProcessor.iter_inventory_chunks(files['inventory']),
+                yj_master=yj_master,
+                return_inventory=True,
+                purchase_index=purchase_index,
+                name_matcher=name_matcher,
+                prioritizer=self.prioritizer)
+
+        return {
+            'result_df': result_df,
+            'inventory_df': inventory_df,
+        }
+
+    def _previous_delta_result(self, pharmacy_id, batch_id):
+        # 薬局の前回の差分保存（batch_id より前で、スナップショットがあるもの）の
+        # 処理結果。ない場合（初回や pyarrow がない場合）は None
+        if not self.snapshots.available:
+            return None
+        for batch in self.db.get_upload_batches(pharmacy_id):
+            if (batch['delta'] and batch['id'] < batch_id
+                    and self.snapshots.exists(batch['id'])):
+                return self.snapshots.load(batch['id'])
+        return None
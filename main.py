@@ -1,9 +1,221 @@
+import json
+import os
 import streamlit as st
-import pandas as pd
 from datetime import datetime
+import database
+import instrumentation
 from auth import Auth
-from file_processor import FileProcessor
-from database import Database
+
+# pandas・openpyxl などを使うモジュール（file_processor・job_queue・
+# pipeline_cache）は、ログイン画面の表示を速くするため使う時に読み込む
+# （instrumentation.import_module で読み込み時間を記録する）
+
+
+@st.cache_resource
+def get_pipeline_cache():
+    # プロセス全体で共有する処理結果のキャッシュ
+    return instrumentation.import_module('pipeline_cache').PipelineCache()
+
+
+@st.cache_resource
+def get_job_queue():
+    # プロセス全体で共有するジョブのワーカー
+    job_queue = instrumentation.import_module('job_queue')
+    return job_queue.JobQueue(cache=get_pipeline_cache())
+
+
+@st.fragment(run_every=2)
+def show_job_progress(jobs, job_id):
+    # 処理が終わるまで状態を定期的に確認し、終わったら画面全体を再実行する
+    pending = instrumentation.import_module('job_queue').PENDING_STATUSES
+    job = jobs.status(job_id)
+    if job['status'] not in pending:
+        st.rerun()
+    if job['status'] == 'queued':
+        st.info("処理の順番を待っています...")
+    else:
+        st.info(f"データを処理中...（{job['elapsed']:.0f}秒経過）")
+
+
+def show_job_result(jobs, job, cache):
+    FileProcessor = instrumentation.import_module(
+        'file_processor').FileProcessor
+    result = cache.get(('result', job['upload_key'], job['delta']))
+
+    # 結果の表示（処理したプロセスのキャッシュにある場合）
+    st.subheader("処理結果")
+    if result is not None:
+        st.dataframe(result['result_df'])
+        excel = result['excel']
+    else:
+        excel = jobs.result(job['id'])
+
+    # Excelダウンロードボタン
+    # 現在の日付を取得してファイル名を生成
+    current_date = datetime.now().strftime('%Y%m%d')
+    excel_filename = f"不良在庫_法人別_{current_date}.xlsx"
+
+    st.download_button(
+        label="Excel形式でダウンロード",
+        data=excel,
+        file_name=excel_filename,
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+    # 法人・院所ごとのファイルをZIPでダウンロード
+    if result is not None:
+        partition_by = st.radio("ファイルの分割単位", ['院所名', '法人名'],
+                                horizontal=True)
+        include_combined = st.checkbox("全院所をまとめたファイルも含める")
+        zip_bytes = cache.get_or_compute(
+            ('zip', job['upload_key'], partition_by, include_combined),
+            lambda: FileProcessor.generate_excel_zip(
+                result['result_df'],
+                partition_by=partition_by,
+                include_combined=include_combined,
+                cache=cache).getvalue())
+        st.download_button(
+            label=f"{partition_by}ごとのファイルをZIPでダウンロード",
+            data=zip_bytes,
+            file_name=f"不良在庫_{partition_by}別_{current_date}.zip",
+            mime="application/zip"
+        )
+
+    if job['batch_id'] is not None:
+        delta = (job['timings'] or {}).get('summary', {}).get('delta')
+        if delta is not None:
+            st.success(f"データベースに差分を保存しました（追加 {delta['inserted']:,} / "
+                       f"変更 {delta['updated']:,} / 削除 {delta['deleted']:,} / "
+                       f"変更なし {delta['unchanged']:,}）")
+            if 'changed_clinics' in delta:
+                st.info(f"Excelには前回の差分保存から内容が変わった院所"
+                        f"（{delta['changed_clinics']:,}件）のシートだけを出力しました")
+        else:
+            st.success("データベースに保存しました")
+
+
+def show_snapshots(pharmacy_id):
+    # 過去のアップロードの処理結果（スナップショット）を表示・再出力する
+    # 元のファイルやデータベースの在庫は読み直さない
+    # pandas・pyarrow を読み込むため、表示を選んだ時だけ読み込む（ジョブの
+    # ワーカーは起動しない）
+    if not st.checkbox("過去の処理結果を表示"):
+        return
+    snapshots = instrumentation.import_module(
+        'snapshot_store').SnapshotStore()
+    if not snapshots.available:
+        st.info("pyarrow がないため、処理結果は保存されていません")
+        return
+    FileProcessor = instrumentation.import_module(
+        'file_processor').FileProcessor
+    cache = get_pipeline_cache()
+    batches = [
+        batch
+        for batch in database.Database().get_upload_batches(pharmacy_id)
+        if snapshots.exists(batch['id'])
+    ]
+    if not batches:
+        st.info("保存された処理結果はありません")
+        return
+
+    with st.container(border=True):
+        labels = {
+            batch['id']: f"{batch['created_at']:%Y/%m/%d %H:%M}"
+                         f"（{batch['row_count']:,}件"
+                         f"{'・差分' if batch['delta'] else ''}）"
+            for batch in batches
+        }
+        batch_id = st.selectbox("アップロード", list(labels),
+                                format_func=labels.get)
+        info = snapshots.metadata(batch_id)
+        clinics = ['（すべて）'] + sorted(
+            snapshots.load(batch_id, columns=['院所名'])['院所名'].unique())
+        clinic = st.selectbox("院所名", clinics)
+        filters = None if clinic == clinics[0] else [('院所名', '=', clinic)]
+        # 院所で絞り込んだ行だけを読み込む
+        df = snapshots.load(batch_id, filters=filters)
+        st.caption(f"{len(df):,} / {info['rows']:,} 行")
+        st.dataframe(df)
+        excel = cache.get_or_compute(
+            ('snapshot_excel', batch_id, clinic),
+            lambda: FileProcessor.generate_excel(df, streaming=True).getvalue())
+        st.download_button(
+            label="Excel形式でダウンロード",
+            data=excel,
+            file_name=f"不良在庫_法人別_{batch_id}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key="snapshot_download"
+        )
+
+
+def show_batch_result(purchase_file, inventory_files, yj_code_file,
+                      show_diagnostics_panel):
+    # 複数の薬局の不良在庫CSVをまとめて処理し、全薬局の在庫を院所別のExcelにする
+    # 薬局IDはファイル名（拡張子を除く）を使う
+    FileProcessor = instrumentation.import_module(
+        'file_processor').FileProcessor
+    batch_process = instrumentation.import_module('batch_process')
+    cache = get_pipeline_cache()
+    key = ('batch', FileProcessor.content_hash(purchase_file),
+           FileProcessor.content_hash(yj_code_file),
+           tuple((f.name, FileProcessor.content_hash(f))
+                 for f in inventory_files))
+    result = cache.get(key)
+    if result is None:
+        if not st.button(f"{len(inventory_files)}薬局の一括処理を実行"):
+            return
+        processor = batch_process.BatchProcessor(cache=cache)
+        with st.spinner("データを処理中..."), \
+                instrumentation.run('batch',
+                                    files=len(inventory_files)) as report:
+            result = processor.process(
+                purchase_file, yj_code_file,
+                [(f.name, f.getvalue()) for f in inventory_files])
+        result = cache.put(key, {**result, 'report': report.to_dict()})
+
+    st.subheader("処理結果（全薬局）")
+    counts = result['inventory_df'].groupby(FileProcessor.SOURCE_COLUMN,
+                                            sort=False).size()
+    st.caption(" / ".join(f"{name}: {rows:,}件"
+                          for name, rows in counts.items()))
+    st.dataframe(result['result_df'])
+
+    current_date = datetime.now().strftime('%Y%m%d')
+    st.download_button(
+        label="Excel形式でダウンロード",
+        data=result['excel'],
+        file_name=f"不良在庫_全薬局_{current_date}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+    zip_bytes = cache.get_or_compute(
+        key + ('zip',),
+        lambda: FileProcessor.generate_excel_zip(result['result_df'],
+                                                 cache=cache).getvalue())
+    st.download_button(
+        label="院所名ごとのファイルをZIPでダウンロード",
+        data=zip_bytes,
+        file_name=f"不良在庫_全薬局_院所名別_{current_date}.zip",
+        mime="application/zip"
+    )
+
+    if show_diagnostics_panel:
+        show_diagnostics(result['report'])
+
+
+def show_diagnostics(report):
+    # 工程ごとの所要時間・行数・メモリと実行レポート（JSON）
+    with st.expander("診断情報"):
+        st.caption(f"実行ID: {report['run_id']} / 合計 {report['seconds']:.1f}秒"
+                   f" / 最大RSS {report['rss_peak_mb']} MB")
+        st.dataframe(report['stages'], hide_index=True)
+        st.json(report['summary'])
+        st.download_button(
+            label="実行レポートをダウンロード (JSON)",
+            data=json.dumps(report, ensure_ascii=False, indent=2),
+            file_name=f"run-{report['run_id']}.json",
+            mime="application/json"
+        )
+
 
 def main():
     st.set_page_config(
@@ -13,6 +225,9 @@ def main():
     )
 
     # 初期化
+    instrumentation.configure_logging()
+    # データベースの接続・スキーマの作成は画面の表示と並行して行う
+    database.warm_up()
     if 'auth' not in st.session_state:
         st.session_state['auth'] = Auth()
 
@@ -46,6 +261,11 @@ def main():
                             st.error("ユーザー登録に失敗しました")
         else:
             st.write(f"ログインユーザー: {st.session_state['username']}")
+            show_diagnostics_panel = st.checkbox("診断情報を表示")
+            if show_diagnostics_panel:
+                # 起動時の計測（モジュールの読み込み時間・最初の描画までの時間）
+                with st.expander("起動時間"):
+                    st.json(instrumentation.startup_report())
             if st.button("ログアウト"):
                 auth.logout()
                 st.rerun()
@@ -54,6 +274,9 @@ def main():
     if auth.is_logged_in():
         st.title("医薬品不良在庫管理システム")
 
+        # 一括処理では、複数の薬局の不良在庫CSVをまとめて処理する
+        batch_mode = st.checkbox("一括処理（複数の薬局の不良在庫CSV）")
+
         # ファイルアップロードセクション
         col1, col2, col3 = st.columns(3)
         
@@ -67,11 +290,19 @@ def main():
 
         with col2:
             st.subheader("不良在庫データ (CSV)")
-            inventory_file = st.file_uploader(
-                "不良在庫ファイルを選択",
-                type=['csv'],
-                key="inventory"
-            )
+            if batch_mode:
+                inventory_files = st.file_uploader(
+                    "不良在庫ファイルを選択（複数可。ファイル名を薬局IDとして使います）",
+                    type=['csv'],
+                    key="inventories",
+                    accept_multiple_files=True
+                )
+            else:
+                inventory_file = st.file_uploader(
+                    "不良在庫ファイルを選択",
+                    type=['csv'],
+                    key="inventory"
+                )
 
         with col3:
             st.subheader("在庫金額 (CSV)")
@@ -81,49 +312,60 @@ def main():
                 key="yj_code"
             )
 
-        if purchase_file and inventory_file and yj_code_file:
+        if batch_mode:
+            if purchase_file and inventory_files and yj_code_file:
+                try:
+                    show_batch_result(purchase_file, inventory_files,
+                                      yj_code_file, show_diagnostics_panel)
+                except Exception as e:
+                    st.error(f"エラーが発生しました: {str(e)}")
+        else:
+            # 差分モードでは、前回の差分保存から追加・変更・削除されたロットだけを保存する
+            delta_mode = st.checkbox("差分モード（前回から変わったロットだけを保存）")
+
+        if not batch_mode and purchase_file and inventory_file and yj_code_file:
             try:
-                with st.spinner('データを処理中...'):
-                    # ファイル読み込み
-                    purchase_df = FileProcessor.read_excel(purchase_file)
-                    inventory_df = FileProcessor.read_csv(inventory_file, file_type='inventory')
-                    yj_code_df = FileProcessor.read_csv(yj_code_file)
-
-                    # データ処理
-                    result_df = FileProcessor.process_data(
-                        purchase_df,
-                        inventory_df,
-                        yj_code_df
-                    )
-
-                    # 結果の表示
-                    st.subheader("処理結果")
-                    st.dataframe(result_df)
-
-                    # Excelダウンロードボタン
-                    excel = FileProcessor.generate_excel(result_df)
-                    # 現在の日付を取得してファイル名を生成
-                    current_date = datetime.now().strftime('%Y%m%d')
-                    excel_filename = f"不良在庫_法人別_{current_date}.xlsx"
-                    
-                    st.download_button(
-                        label="Excel形式でダウンロード",
-                        data=excel,
-                        file_name=excel_filename,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-
-                    
-
-                    # データベースへの保存
-                    db = Database()
-                    inventory_data = result_df.values.tolist()
-                    db.save_inventory(inventory_data)
-                    st.success("データベースに保存しました")
+                cache = get_pipeline_cache()
+                jobs = get_job_queue()
+                job_queue = instrumentation.import_module('job_queue')
+                username = st.session_state['username']
+                # 3ファイルの内容ハッシュが同じなら、再実行時も同じジョブを使う
+                upload_key = job_queue.JobQueue.upload_key(
+                    purchase_file, inventory_file, yj_code_file)
+                submitted = st.session_state.setdefault('jobs', {})
+                submission = (upload_key, delta_mode)
+                if submission not in submitted:
+                    submitted[submission] = jobs.submit(
+                        username, purchase_file, inventory_file, yj_code_file,
+                        upload_key=upload_key, delta=delta_mode)
+                job_id = submitted[submission]
+
+                job = jobs.status(job_id)
+                if job['status'] in job_queue.PENDING_STATUSES:
+                    show_job_progress(jobs, job_id)
+                elif job['status'] == 'failed':
+                    st.error(f"エラーが発生しました: {job['error']}")
+                    if st.button("再実行"):
+                        del submitted[submission]
+                        st.rerun()
+                else:
+                    show_job_result(jobs, job, cache)
+
+                # ジョブの実行レポート（timings 列に保存される）
+                if show_diagnostics_panel and job['timings']:
+                    show_diagnostics(job['timings'])
 
             except Exception as e:
                 st.error(f"エラーが発生しました: {str(e)}")
 
+        try:
+            show_snapshots(st.session_state['username'])
+        except Exception as e:
+            st.error(f"過去の処理結果の読み込みでエラーが発生しました: {str(e)}")
+
+    # プロセスで最初の画面の描画が終わるまでの時間
+    instrumentation.mark_startup('first_paint')
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     main()
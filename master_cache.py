@@ -0,0 +1,34 @@
+import pandas as pd
+from file_processor import FileProcessor
+
+
+class YJMasterCache:
+    # 在庫金額CSVから作成した 薬品名→(ＹＪコード, 単位, 単価) の対応表を、
+    # ファイル内容のハッシュをキーにデータベースへ保存して再利用する
+
+    def __init__(self, db, keep_versions=5):
+        self.db = db
+        self.keep_versions = keep_versions
+
+    def load(self, file):
+        content_hash = FileProcessor.content_hash(file)
+
+        rows = self.db.get_yj_master(content_hash)
+        if rows is not None:
+            yj_master = pd.DataFrame(
+                rows, columns=['薬品名キー', 'ＹＪコード', '単位',
+                               '単価']).astype({'単価': float})
+            # build_yj_master と同じく単位はカテゴリ型で持つ
+            yj_master['単位'] = FileProcessor.to_category(yj_master['単位'])
+            return yj_master
+
+        # キャッシュにない場合はCSVを読み込んで対応表を作成し、保存する
+        yj_master = FileProcessor.build_yj_master(
+            FileProcessor.read_csv(file))
+        # 単価の NaN はデータベースには NULL で保存する
+        entries = yj_master.astype(object).where(yj_master.notna(), None)
+        self.db.save_yj_master(content_hash,
+                               list(entries.itertuples(index=False,
+                                                       name=None)),
+                               keep_versions=self.keep_versions)
+        return yj_master
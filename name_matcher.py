@@ -0,0 +1,210 @@
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# 照合キーから取り除く空白と括弧（「サワイ」と『サワイ』、(サワイ) などを同じに扱う）
+_IGNORED_CHARACTERS = re.compile(r'[\s「」『』【】〔〕()\[\]]')
+# 規格（5mg の 5 など）の数値。数値が違う薬品は似ていても候補にしない
+_NUMBERS = re.compile(r'\d+(?:\.\d+)?')
+# 塩の表記ゆれ（ロキソプロフェンNa とロキソプロフェンナトリウム）を略号にそろえる
+# マグネシウムの Mg は規格の mg と区別できないため含めない
+_SALTS = {'ナトリウム': 'na', 'カリウム': 'k', 'カルシウム': 'ca'}
+_SALT_NAMES = re.compile('|'.join(_SALTS))
+# 1文字の置換・挿入・削除で変わるトライグラムは両側合わせて最大6個
+# （候補を絞るための必要条件で、1文字違いかどうかは文字列を比べて確かめる）
+_ONE_EDIT_GRAMS = 6
+
+
+class NameMatcher:
+    # 在庫金額マスターの薬品名キー（build_yj_master の対応表）に対する
+    # あいまい照合の索引。完全一致しなかった薬品名を、
+    #   1. 空白・括弧・大文字小文字・塩の表記（Na とナトリウム）を無視した
+    #      キーの一致（照合スコア 1.0）
+    #   2. 3文字単位（トライグラム）の転置索引で候補を集め、Dice 係数で採点
+    # の順に照合する。規格の数値が異なる候補は除外し、Dice 係数が min_score
+    # 以上か、照合キーの編集距離が1（1文字の置換・挿入・削除）の候補のうち
+    # 最高点のものを採る。別のＹＪコードの候補と同点の場合や、編集距離1の候補が
+    # 別のＹＪコードにもある場合（ファモチジンD錠 と ファモチジン錠・OD錠）は照合しない
+    # Dice 係数は名前が短いほど1文字の違いで大きく下がる
+    # （アムロジビン錠5mg「サワイ」とアムロジピン錠5mg「サワイ」で 0.77）ため、
+    # 打ち間違いは長さによらず編集距離で受け入れる。2文字以上違うもの
+    # （アムロジピン錠5mg と OD錠5mg、「EP」と「DSEP」で 0.77）は別の薬品として、
+    # min_score 以上の場合だけ照合する
+    # 出現数が max_postings を超えるトライグラム（「錠」を含むものなど）は
+    # 候補集めに使わず（採点の分母には含める）、1件あたりの照合時間を抑える
+
+    def __init__(self, yj_master, min_score=0.85, max_postings=None):
+        self.min_score = min_score
+        self.keys = yj_master['薬品名キー'].to_numpy()
+        self.codes = yj_master['ＹＪコード'].to_numpy()
+        if max_postings is None:
+            max_postings = max(50, len(self.keys) // 10)
+        self.max_postings = max_postings
+
+        with instrumentation.stage('process.name_index',
+                                   rows_in=len(self.keys)) as metrics:
+            match_keys = [self.match_key(key) for key in self.keys]
+            # 照合キー → 対応表の行（同じキーが複数ある場合は照合しない）
+            exact = pd.Series(np.arange(len(match_keys)), index=match_keys)
+            self.exact = exact[~exact.index.duplicated(keep=False)]
+            self.numbers = [self._numbers(key) for key in match_keys]
+
+            postings = {}
+            self.grams = [self._trigrams(key) for key in match_keys]
+            self.gram_counts = np.array([len(grams) for grams in self.grams],
+                                        dtype=np.int32)
+            for i, grams in enumerate(self.grams):
+                for gram in grams:
+                    postings.setdefault(gram, []).append(i)
+            self.postings = {
+                gram: np.array(ids, dtype=np.int32)
+                for gram, ids in postings.items()
+            }
+            metrics['trigrams'] = len(self.postings)
+        self._nbytes = None
+
+    def memory_usage(self):
+        # 索引のおおよそのバイト数（PipelineCache の容量の計算に使う）
+        # sys.getsizeof はオブジェクト本体しか数えないため、中身を辿って合計する
+        if self._nbytes is None:
+            # トライグラムや規格の数値は薬品ごとに別の文字列オブジェクトになる
+            strings = {id(s): s for s in self.postings}
+            strings.update((id(s), s) for s in self.keys if isinstance(s, str))
+            strings.update((id(s), s) for s in self.exact.index)
+            for grams in self.grams:
+                strings.update((id(s), s) for s in grams)
+            for numbers in self.numbers:
+                strings.update((id(s), s) for s in numbers)
+            nbytes = sum(sys.getsizeof(s) for s in strings.values())
+            nbytes += self.keys.nbytes + self.codes.nbytes
+            nbytes += int(self.exact.memory_usage(index=False))
+            nbytes += sys.getsizeof(self.exact.index.to_numpy())
+            nbytes += sys.getsizeof(self.numbers) + sum(
+                sys.getsizeof(numbers) for numbers in self.numbers)
+            nbytes += sys.getsizeof(self.grams) + sum(
+                sys.getsizeof(grams) for grams in self.grams)
+            nbytes += self.gram_counts.nbytes + sys.getsizeof(self.postings)
+            nbytes += sum(sys.getsizeof(ids) for ids in self.postings.values())
+            self._nbytes = nbytes
+        return self._nbytes
+
+    @staticmethod
+    def match_key(name):
+        # NFKC 済みの薬品名キーから空白・括弧を除き、塩の名前を略号にして
+        # 小文字にしたもの
+        name = _IGNORED_CHARACTERS.sub('', name)
+        return _SALT_NAMES.sub(lambda m: _SALTS[m.group()], name).lower()
+
+    @staticmethod
+    def _trigrams(key):
+        # 前後に境界記号を付けて、短い薬品名でもトライグラムを作れるようにする
+        padded = f'^{key}$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def _one_edit(a, b):
+        # a と b の編集距離（レーベンシュタイン距離）が1以下かどうか
+        if len(a) > len(b):
+            a, b = b, a
+        if len(b) - len(a) > 1:
+            return False
+        # 先頭と末尾の一致する部分を除いた残りが、どちらも1文字以下なら1文字違い
+        start = 0
+        while start < len(a) and a[start] == b[start]:
+            start += 1
+        end = 0
+        while (end < len(a) - start
+               and a[len(a) - 1 - end] == b[len(b) - 1 - end]):
+            end += 1
+        return len(b) - start - end <= 1
+
+    @staticmethod
+    def _numbers(key):
+        return tuple(_NUMBERS.findall(key))
+
+    def match(self, keys):
+        # 薬品名キー（NFKC 済み）の配列を照合し、入力と同じ順で
+        # 薬品名キー（対応表側）と照合スコアの DataFrame を返す
+        # 照合できなかった行はどちらも NaN
+        keys = pd.Series(keys, dtype=object)
+        codes, unique_keys = pd.factorize(keys)
+        with instrumentation.stage('process.name_match',
+                                   rows_in=len(unique_keys)) as metrics:
+            rows = np.full(len(unique_keys), -1, dtype=np.int64)
+            scores = np.full(len(unique_keys), np.nan)
+            for i, key in enumerate(unique_keys):
+                rows[i], scores[i] = self._match_one(self.match_key(key))
+            metrics['matched'] = int((rows >= 0).sum())
+
+        found = rows >= 0
+        # 対応表が空の場合もあるため、照合できた行だけを参照する
+        matched_keys = np.full(len(unique_keys), None, dtype=object)
+        matched_keys[found] = self.keys[rows[found]]
+        result = pd.DataFrame({
+            '薬品名キー': matched_keys,
+            '照合スコア': scores,
+        })
+        if len(keys) == 0:
+            return result
+        # pd.factorize は欠損値を -1 にするため、照合なしの行を末尾に足して参照する
+        result = pd.concat(
+            [result, pd.DataFrame({'薬品名キー': [None], '照合スコア': [np.nan]})],
+            ignore_index=True)
+        return result.iloc[codes].reset_index(drop=True)
+
+    def _match_one(self, key):
+        # 照合した対応表の行と照合スコアを返す（照合できない場合は -1, NaN）
+        if key in self.exact.index:
+            return self.exact[key], 1.0
+
+        grams = self._trigrams(key)
+        if not grams:
+            return -1, np.nan
+        lists = [
+            ids for ids in (self.postings.get(gram) for gram in grams)
+            if ids is not None and len(ids) <= self.max_postings
+        ]
+        if not lists:
+            return -1, np.nan
+        candidates, shared = np.unique(np.concatenate(lists),
+                                       return_counts=True)
+        # 候補集めに使わなかったトライグラムも一致しているものとして数える
+        # （過大評価になるため、最終的な採点は全トライグラムでやり直す）
+        shared = shared + len(grams) - len(lists)
+        total = len(grams) + self.gram_counts[candidates]
+        candidates = candidates[(2 * shared / total >= self.min_score) |
+                                (total - 2 * shared <= _ONE_EDIT_GRAMS)]
+        if len(candidates) == 0:
+            return -1, np.nan
+
+        numbers = self._numbers(key)
+        best_row, best_score, best_codes = -1, 0.0, set()
+        one_edit_codes = set()
+        for row in candidates:
+            if self.numbers[row] != numbers:
+                continue
+            shared = len(grams & self.grams[row])
+            total = len(grams) + self.gram_counts[row]
+            score = 2 * shared / total
+            if total - 2 * shared <= _ONE_EDIT_GRAMS and self._one_edit(
+                    key, self.match_key(self.keys[row])):
+                one_edit_codes.add(self.codes[row])
+            elif score < self.min_score:
+                continue
+            if score > best_score:
+                best_row, best_score, best_codes = row, score, {
+                    self.codes[row]
+                }
+            elif score == best_score:
+                best_codes.add(self.codes[row])
+
+        if best_row < 0 or len(best_codes) > 1:
+            return -1, np.nan
+        # 打ち間違いとして受け入れた場合、どの薬品の打ち間違いか決められないものは照合しない
+        if best_score < self.min_score and len(one_edit_codes) > 1:
+            return -1, np.nan
+        return best_row, round(best_score, 4)
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class PipelineCache:
+    # アップロードされたファイルの内容ハッシュをキーに、読み込んだデータ・
+    # 処理結果・Excelのバイト列を保持する。合計サイズが max_bytes を
+    # 超えた場合は、最も長く使われていないものから削除する（LRU）
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('PIPELINE_CACHE_MB', 256)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(deep=True).sum())
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        if isinstance(value, dict):
+            return sum(PipelineCache._sizeof(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(PipelineCache._sizeof(v) for v in value)
+        # 索引など、中身の大きさを自分で見積もれるもの（NameMatcher.memory_usage）
+        if hasattr(value, 'memory_usage'):
+            return int(value.memory_usage())
+        return sys.getsizeof(value)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            # 上限より大きいものは保持しない
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+
+class Prioritizer:
+    # process_data の結果に、引き取りを依頼する優先度（0〜1）を付けて並べ替える
+    #   期限: 使用期限までの日数が horizon_days より短いほど高い（期限切れは 0）
+    #   金額: 在庫量 × 単価（在庫金額CSVの 在庫金額 / 在庫量）の対数
+    #   購入: 院所の購入回数の対数 × 最終購入日の新しさ（recency_days で 0）
+    # を重み付きで合計する。top_n を指定すると院所ごとに上位 top_n 件だけを残し、
+    # min_score を指定するとそれ未満の行を除く
+    # 計算は列単位（NumPy）で行い、値のない項目は 0 として扱う
+
+    # 採点に使う列（在庫金額CSV・購入履歴にある場合のみ結果に含まれる）
+    FEATURE_COLUMNS = ['単価', '購入回数', '最終購入日']
+
+    def __init__(self,
+                 expiry_weight=0.5,
+                 value_weight=0.3,
+                 affinity_weight=0.2,
+                 horizon_days=365,
+                 recency_days=365,
+                 top_n=None,
+                 min_score=None,
+                 today=None):
+        self.weights = np.array([expiry_weight, value_weight, affinity_weight],
+                                dtype=float)
+        if self.weights.sum() <= 0:
+            raise ValueError("優先度の重みの合計は正の値にしてください")
+        self.horizon_days = horizon_days
+        self.recency_days = recency_days
+        self.top_n = top_n
+        self.min_score = min_score
+        # 基準日（未指定の場合は採点した日）
+        self.today = today
+
+    @staticmethod
+    def _log_scale(values):
+        # 0 以上の値を log1p で 0〜1 に揃える（最大値が 1）
+        values = np.log1p(np.nan_to_num(np.clip(values, 0, None)))
+        peak = values.max(initial=0)
+        return values / peak if peak > 0 else values
+
+    @staticmethod
+    def _by_value(values, convert):
+        # 値の種類ごとに一度だけ変換する（在庫量・使用期限は重複が多い）
+        codes, uniques = pd.factorize(values)
+        converted = np.append(convert(pd.Series(uniques)).to_numpy(float), np.nan)
+        return converted[codes]
+
+    @staticmethod
+    def _numbers(values):
+        return Prioritizer._by_value(
+            values, lambda v: pd.to_numeric(v, errors='coerce'))
+
+    @staticmethod
+    def _days_until(dates, today):
+        return Prioritizer._by_value(
+            dates, lambda v: (pd.to_datetime(v, errors='coerce') - today) /
+            pd.Timedelta(days=1))
+
+    def score(self, df):
+        # 行ごとの優先度（0〜1）を返す
+        today = pd.Timestamp(self.today or pd.Timestamp.now()).normalize()
+        days = self._days_until(df['使用期限'], today)
+        expiry = np.where(days >= 0,
+                          np.clip(1 - days / self.horizon_days, 0, 1), 0)
+        expiry = np.nan_to_num(expiry)
+
+        value = np.zeros(len(df))
+        if '単価' in df.columns:
+            value = self._log_scale(
+                self._numbers(df['在庫量']) * self._numbers(df['単価']))
+
+        affinity = np.zeros(len(df))
+        if '購入回数' in df.columns:
+            affinity = self._log_scale(self._numbers(df['購入回数']))
+            if '最終購入日' in df.columns:
+                age = -self._days_until(df['最終購入日'], today)
+                affinity = affinity * np.nan_to_num(
+                    np.clip(1 - age / self.recency_days, 0, 1))
+
+        components = np.column_stack([expiry, value, affinity])
+        return (components @ self.weights / self.weights.sum()).round(4)
+
+    def rank(self, df):
+        # 法人名・院所名の順に並べ、院所の中は優先度の高い順にする
+        # 採点に使った列は結果から除き、優先度の列は残さない（Excelの列は変えない）
+        # 並べ替え・絞り込みはキーの列だけで行い、結果の行と列は最後に一度だけ取り出す
+        with instrumentation.stage('process.prioritize',
+                                   rows_in=len(df)) as metrics:
+            keys = pd.DataFrame({
+                '法人名': df['法人名'].array,
+                '院所名': df['院所名'].array,
+                '優先度': self.score(df),
+            })
+            if self.min_score is not None:
+                keys = keys[keys['優先度'] >= self.min_score]
+            keys = keys.sort_values(['法人名', '院所名', '優先度'],
+                                    ascending=[True, True, False],
+                                    kind='stable')
+            if self.top_n is not None:
+                keys = keys[keys.groupby(['法人名', '院所名'],
+                                         sort=False,
+                                         observed=True).cumcount() <
+                            self.top_n]
+            columns = [
+                col for col in df.columns if col not in self.FEATURE_COLUMNS
+            ]
+            ranked = df.iloc[keys.index.to_numpy(),
+                             [df.columns.get_loc(col) for col in columns]]
+            metrics['rows_out'] = len(ranked)
+        return ranked
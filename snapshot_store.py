@@ -0,0 +1,119 @@
+import importlib.util
+import os
+from datetime import datetime
+
+import instrumentation
+
+# pyarrow はオプション（ない場合はスナップショットを保存しない）
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+if HAS_PYARROW:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+
+class SnapshotStore:
+    # process_data の結果を、アップロードのバッチごとに Parquet（zstd 圧縮）で
+    # 保存する。読み込み時は必要な列だけを memory_map で読み込むため、
+    # 過去の結果の表示・再出力・比較で元のCSV/XLSXやデータベースを読み直さない
+    # 保存先の既定値は環境変数 SNAPSHOT_DIR（未設定時は snapshots）
+
+    def __init__(self, root=None, compression='zstd'):
+        self.root = root or os.environ.get('SNAPSHOT_DIR', 'snapshots')
+        self.compression = compression
+
+    @property
+    def available(self):
+        return HAS_PYARROW
+
+    def path(self, batch_id, name='result'):
+        return os.path.join(self.root, f'batch-{batch_id}', f'{name}.parquet')
+
+    def exists(self, batch_id, name='result'):
+        return os.path.exists(self.path(batch_id, name))
+
+    def save(self, batch_id, df, name='result', **metadata):
+        # スナップショットを保存してパスを返す（pyarrow がない場合は None）
+        # 同じバッチの保存済みのものは上書きしない
+        if not HAS_PYARROW:
+            return None
+        path = self.path(batch_id, name)
+        if os.path.exists(path):
+            return path
+
+        with instrumentation.stage('snapshot.save', rows_in=len(df)) as metrics:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            metadata = {
+                'batch_id': str(batch_id),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                **{key: str(value) for key, value in metadata.items()},
+            }
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                **{f'snapshot.{key}'.encode(): value.encode()
+                   for key, value in metadata.items()},
+            })
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書き込み途中のファイルを読まないよう、一時ファイルから置き換える
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            pq.write_table(table, temp_path, compression=self.compression)
+            os.replace(temp_path, path)
+            metrics['bytes'] = os.path.getsize(path)
+        return path
+
+    def load(self, batch_id, columns=None, filters=None, name='result'):
+        # スナップショットを DataFrame で返す。columns で読み込む列を、
+        # filters（例: [('院所名', '=', '中央クリニック0')]）で行を絞り込める
+        with instrumentation.stage('snapshot.load') as metrics:
+            table = pq.read_table(self.path(batch_id, name),
+                                  columns=columns,
+                                  filters=filters,
+                                  memory_map=True)
+            metrics['rows_out'] = table.num_rows
+            return table.to_pandas()
+
+    def iter_batches(self, batch_id, columns=None, batch_size=65536,
+                     name='result'):
+        # 大きなスナップショットを batch_size 行ずつ DataFrame で返す
+        parquet_file = pq.ParquetFile(self.path(batch_id, name),
+                                      memory_map=True)
+        for record_batch in parquet_file.iter_batches(batch_size=batch_size,
+                                                      columns=columns):
+            yield record_batch.to_pandas()
+
+    def compare(self, old_batch_id, new_batch_id, columns=None,
+                name='result'):
+        # 2つのスナップショットを比べ、増えた行となくなった行を返す
+        old = self.load(old_batch_id, columns, name=name).drop_duplicates()
+        new = self.load(new_batch_id, columns, name=name).drop_duplicates()
+        merged = old.merge(new, how='outer', indicator=True)
+        return {
+            'added':
+            merged[merged['_merge'] == 'right_only'].drop(columns='_merge'),
+            'removed':
+            merged[merged['_merge'] == 'left_only'].drop(columns='_merge'),
+        }
+
+    def metadata(self, batch_id, name='result'):
+        # 保存時のメタデータと行数・列名（データ本体は読まない）
+        parquet_file = pq.ParquetFile(self.path(batch_id, name),
+                                      memory_map=True)
+        schema_metadata = parquet_file.schema_arrow.metadata or {}
+        info = {
+            key.decode()[len('snapshot.'):]: value.decode()
+            for key, value in schema_metadata.items()
+            if key.startswith(b'snapshot.')
+        }
+        info.update(rows=parquet_file.metadata.num_rows,
+                    columns=parquet_file.schema_arrow.names)
+        return info
+
+    def batch_ids(self):
+        # 保存済みのバッチID（新しい順）
+        if not os.path.isdir(self.root):
+            return []
+        ids = [
+            int(entry[len('batch-'):]) for entry in os.listdir(self.root)
+            if entry.startswith('batch-') and entry[len('batch-'):].isdigit()
+        ]
+        return sorted(ids, reverse=True)